@@ -0,0 +1,97 @@
+"""
+JSON codec benchmark of `codec.loads` and `codec.dumps` against the standard library.
+
+Decodes and encodes the given payloads, such as the Rozetka responses saved with `log_queries` under
+platforms/fetched/rozetka/, and prints the milliseconds per call of the codec backend and of `json`. Without files it
+runs on a generated page shaped like a Rozetka search response.
+
+    python bench_codec.py [--iterations 200] [--products 60] [file.json ...]
+"""
+import argparse
+import json
+import random
+import time
+
+import codec
+
+
+def rozetka_page(count: int) -> bytes:
+    """A search response page of `count` goods with the fields of the Rozetka search API."""
+    goods = [{
+        'id': 300_000_000 + i,
+        'title': f'Смартфон Product {i} 8/256GB Black',
+        'href': f'https://rozetka.com.ua/ua/product-{i}/p{300_000_000 + i}/',
+        'image_main': f'https://content.rozetka.com.ua/goods/images/big/{400_000_000 + i}.jpg',
+        'images': {'main': f'https://content.rozetka.com.ua/goods/images/big/{400_000_000 + i}.jpg',
+                   'preview': f'https://content.rozetka.com.ua/goods/images/preview/{400_000_000 + i}.jpg'},
+        'brand': random.choice(('Samsung', 'Apple', 'Xiaomi', 'Motorola')),
+        'brand_id': random.randint(1, 5000),
+        'price': random.randint(3000, 60000),
+        'old_price': random.randint(3000, 70000),
+        'price_pcs': '',
+        'status': random.choice(('available', 'limited', 'out_of_stock')),
+        'sell_status': 'available',
+        'seller_id': 5,
+        'merchant_id': 1,
+        'category_id': 80003,
+        'comments_amount': random.randint(0, 500),
+        'comments_mark': round(random.uniform(3, 5), 1),
+        'stars': f'{random.randint(60, 100)}%',
+        'discount': random.randint(0, 30),
+        'docket': 'Екран (6.7", AMOLED, 2400x1080) / 8 ГБ / 256 ГБ / 5000 мА*год',
+        'tags': [{'name': 'action', 'title': 'Акція', 'priority': 10}],
+        'pl_bonus_charge_pcs': random.randint(0, 300),
+    } for i in range(count)]
+
+    return json.dumps({'data': {
+        'goods': goods,
+        'pagination': {'total_pages': 20, 'shown_page': 1},
+        'total': count * 20,
+        'request_params': {'text': 'смартфон', 'page': 1},
+    }}).encode()
+
+
+def timed(func, payload, iterations: int) -> float:
+    """Average milliseconds per call."""
+    timer = time.perf_counter()
+    for _ in range(iterations):
+        func(payload)
+    return (time.perf_counter() - timer) * 1000 / iterations
+
+
+def bench(name: str, payload: bytes, iterations: int):
+    data = json.loads(payload)
+
+    calls = {
+        'loads': (codec.loads, json.loads, payload),
+        'dumps': (codec.dumps, lambda d: json.dumps(d).encode(), data),
+        'dumps indent': (lambda d: codec.dumps(d, indent=True), lambda d: json.dumps(d, indent=2).encode(), data),
+    }
+
+    print('')
+    print(f'{name}: {len(payload)} bytes, {iterations} iterations')
+    print(f'{"":<14}{codec.name + " ms":>12}{"json ms":>12}{"speedup":>10}')
+    for call, (fast, stdlib, argument) in calls.items():
+        fast_ms, stdlib_ms = timed(fast, argument, iterations), timed(stdlib, argument, iterations)
+        print(f'{call:<14}{fast_ms:>12.3f}{stdlib_ms:>12.3f}{stdlib_ms / fast_ms:>9.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON codec benchmark against the standard library')
+    parser.add_argument('files', nargs='*', help='recorded JSON payloads')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--products', type=int, default=60, help='goods of the generated page')
+    args = parser.parse_args()
+
+    print('Codec backend:', codec.name)
+
+    if not args.files:
+        bench(f'Generated Rozetka page of {args.products} goods', rozetka_page(args.products), args.iterations)
+
+    for path in args.files:
+        with open(path, 'rb') as f:
+            bench(path, f.read(), args.iterations)
+
+
+if __name__ == '__main__':
+    main()
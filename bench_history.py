@@ -0,0 +1,144 @@
+"""
+History query benchmark before and after the history and goods lookup indexes (migration 2).
+
+Creates a database at schema version 1, generates goods and their price and stock status history, times `get_prices`,
+`get_in_stock` and `get_good_id` lookups, applies migration 2 and times them again. SQLite runs on a temporary
+database. MySQL runs on the database of the MYSQL_* variables used by the service (MYSQL_DB defaults to
+'project-d-bench' here), which must be empty.
+
+    python bench_history.py [--db sqlite|mysql] [--goods 10000] [--samples 150] [--lookups 50]
+"""
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import time
+
+import migrations
+from db import DB, SqLiteDB, MySQLDB
+
+# Rows written per transaction while generating the dataset
+CHUNK_SIZE = 50_000
+
+
+def generate(db: DB, goods: int, samples: int):
+    """Add `goods` goods with `samples` prices and stock statuses each, interleaved like successive update runs."""
+    p = '%s' if db.db_type == 'mysql' else '?'
+    query_id = db.add_query('bench history')
+
+    def insert_goods(cnx):
+        cur = cnx.cursor()
+        cur.executemany(f'INSERT INTO goods (platform, platform_id, query_id, name, href) '
+                        f'VALUES ({p}, {p}, {p}, {p}, {p})',
+                        [('bench', platform_id, query_id, f'Product {platform_id}', f'/goods/{platform_id}')
+                         for platform_id in range(goods)])
+        cur.execute(f'SELECT id FROM goods WHERE query_id = {p}', (query_id,))
+        good_ids = [row[0] for row in cur.fetchall()]
+        cur.close()
+        return good_ids
+
+    good_ids = db.run_in_transaction(insert_goods)
+
+    # One sample of every good per run, 30 minutes apart
+    start = time.time() - samples * 30 * 60
+    rows = ((good_id, sample) for sample in range(samples) for good_id in good_ids)
+
+    while chunk := list(itertools.islice(rows, CHUNK_SIZE)):
+        def insert_history(cnx):
+            cur = cnx.cursor()
+            timestamps = {sample: time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start + sample * 30 * 60))
+                          for sample in {sample for _, sample in chunk}}
+            cur.executemany(f'INSERT INTO prices (good_id, price, timestamp) VALUES ({p}, {p}, {p})',
+                            [(good_id, random.randint(100, 200), timestamps[sample]) for good_id, sample in chunk])
+            cur.executemany(f'INSERT INTO in_stock (good_id, in_stock, timestamp) VALUES ({p}, {p}, {p})',
+                            [(good_id, random.random() < 0.8, timestamps[sample]) for good_id, sample in chunk])
+            cur.close()
+
+        db.run_in_transaction(insert_history)
+
+    return query_id, good_ids
+
+
+def time_lookups(db: DB, query_id: int, good_ids: [int], lookups: int) -> dict[str, float]:
+    """Average milliseconds per call of the history and goods lookups."""
+    sample = random.sample(good_ids, min(lookups, len(good_ids)))
+    platform_ids = random.sample(range(len(good_ids)), len(sample))
+
+    calls = {
+        'get_prices': lambda i: db.get_prices(sample[i]),
+        'get_in_stock': lambda i: db.get_in_stock(sample[i]),
+        'get_good_id': lambda i: db.get_good_id(platform_ids[i], query_id),
+    }
+
+    results = {}
+    for name, call in calls.items():
+        timer = time.perf_counter()
+        for i in range(len(sample)):
+            call(i)
+        results[name] = (time.perf_counter() - timer) * 1000 / len(sample)
+
+    return results
+
+
+def bench(db: DB, goods: int, samples: int, lookups: int):
+    # Schema version 1, the history tables without their indexes
+    all_migrations = migrations.MIGRATIONS
+    migrations.MIGRATIONS = [migration for migration in all_migrations if migration[0] <= 1]
+    try:
+        db.db_init()
+    finally:
+        migrations.MIGRATIONS = all_migrations
+
+    if migrations.schema_version(db) != 1:
+        print('The benchmark needs an empty database')
+        return
+
+    print('')
+    print(f'Generating {goods} goods with {samples} samples each...')
+    timer = time.time()
+    query_id, good_ids = generate(db, goods, samples)
+    print('Rows:', db.count_rows(['goods', 'prices', 'in_stock']), 'in', round(time.time() - timer, 1), 's')
+
+    before = time_lookups(db, query_id, good_ids, lookups)
+
+    # Apply migration 2 only
+    migrations.MIGRATIONS = [migration for migration in all_migrations if migration[0] <= 2]
+    try:
+        timer = time.time()
+        migrations.migrate(db)
+        print('Migration 2 in', round(time.time() - timer, 1), 's')
+    finally:
+        migrations.MIGRATIONS = all_migrations
+
+    after = time_lookups(db, query_id, good_ids, lookups)
+
+    print('')
+    print(f'{"":<14}{"before ms":>12}{"after ms":>12}{"speedup":>10}')
+    for name in before:
+        print(f'{name:<14}{before[name]:>12.3f}{after[name]:>12.3f}{before[name] / after[name]:>9.0f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='History query benchmark before and after migration 2')
+    parser.add_argument('--db', choices=('sqlite', 'mysql'), default='sqlite')
+    parser.add_argument('--goods', type=int, default=10_000)
+    parser.add_argument('--samples', type=int, default=150)
+    parser.add_argument('--lookups', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.db == 'sqlite':
+        with tempfile.TemporaryDirectory() as db_dir:
+            db = SqLiteDB('bench.sqlite', db_dir)
+            bench(db, args.goods, args.samples, args.lookups)
+            db.db_close()
+    else:
+        db = MySQLDB(os.getenv('MYSQL_ADDR', '127.0.0.1'), int(os.getenv('MYSQL_PORT', 3306)),
+                     os.getenv('MYSQL_USER', 'root'), os.getenv('MYSQL_PASSWORD'),
+                     os.getenv('MYSQL_DB', 'project-d-bench'))
+        bench(db, args.goods, args.samples, args.lookups)
+        db.db_close()
+
+
+if __name__ == '__main__':
+    main()
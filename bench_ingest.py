@@ -0,0 +1,89 @@
+"""
+Concurrent ingest throughput benchmark.
+
+Runs N writer threads, each ingesting batches of products of its own query with `DB.ingest_snapshot`, and prints the
+rows written per second for N = 1, 4 and 16 writers. SQLite runs on a temporary database. MySQL runs on the database
+of the MYSQL_* variables used by the service (MYSQL_DB defaults to 'project-d-bench' here), into queries added by the
+benchmark.
+
+    python bench_ingest.py [--db sqlite|mysql|all] [--batches 20] [--products 500]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from db import DB, SqLiteDB, MySQLDB
+
+WRITERS = (1, 4, 16)
+
+
+def products(writer: int, count: int) -> [dict]:
+    return [{'id': writer * 1_000_000 + i, 'name': f'Product {i}', 'href': f'/goods/{writer}/{i}', 'img_href': None,
+             'brand': 'Bench', 'price': random.randint(100, 200), 'in_stock': random.random() < 0.8}
+            for i in range(count)]
+
+
+def run(db: DB, writers: int, batches: int, count: int) -> (int, float):
+    """Ingest `batches` batches of `count` products from every writer, returns the rows written and the seconds."""
+    query_ids = [db.add_query(f'bench {writers} writers #{writer} {time.time()}') for writer in range(writers)]
+    rows = [0] * writers
+    errors = []
+
+    def write(writer: int):
+        try:
+            for batch in range(batches):
+                stats = db.ingest_snapshot('bench', query_ids[writer], products(writer, count), time.time() + batch)
+                rows[writer] += stats['rows']
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    timer = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - timer
+
+    if errors:
+        raise errors[0]
+    return sum(rows), seconds
+
+
+def bench(name: str, db: DB, batches: int, count: int):
+    db.db_init()
+
+    print('')
+    print(f'{name}: {batches} batches of {count} products per writer')
+    for writers in WRITERS:
+        rows, seconds = run(db, writers, batches, count)
+        print(f'{writers:>3} writers: {rows:>9} rows in {seconds:7.2f} s, {rows / seconds:10.0f} rows/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent ingest throughput benchmark')
+    parser.add_argument('--db', choices=('sqlite', 'mysql', 'all'), default='sqlite')
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--products', type=int, default=500)
+    args = parser.parse_args()
+
+    if args.db in ('sqlite', 'all'):
+        with tempfile.TemporaryDirectory() as db_dir:
+            db = SqLiteDB('bench.sqlite', db_dir)
+            bench('SQLite', db, args.batches, args.products)
+            db.db_close()
+
+    if args.db in ('mysql', 'all'):
+        # One pooled connection per writer
+        db = MySQLDB(os.getenv('MYSQL_ADDR', '127.0.0.1'), int(os.getenv('MYSQL_PORT', 3306)),
+                     os.getenv('MYSQL_USER', 'root'), os.getenv('MYSQL_PASSWORD'),
+                     os.getenv('MYSQL_DB', 'project-d-bench'), pool_size=max(WRITERS))
+        bench('MySQL', db, args.batches, args.products)
+        db.db_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+JSON codec used for fetched pages, fetch logs and API responses.
+
+Uses orjson when it is installed and falls back to the stdlib `json` otherwise. orjson stays optional because it
+has no PyPy build (see Dockerfile-PyPy), the CPython image installs it.
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any
+
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+import profiling
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+name: str = 'orjson' if orjson else 'json'
+
+
+def default(obj: Any) -> Any:
+    """Encode the values returned by the DB drivers that JSON has no type for."""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return obj.decode()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def loads(data: bytes | str) -> Any:
+    with profiling.span('decode', size=len(data)):
+        if orjson:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0))
+    return json.dumps(obj, default=default, indent=2 if indent else None).encode()
+
+
+def dump(obj: Any, path: str, indent: bool = True):
+    """Write `obj` as JSON to the file at `path`."""
+    with open(path, 'wb') as f:
+        f.write(dumps(obj, indent))
+
+
+class JSONResponse(StarletteJSONResponse):
+    """JSON response rendered with the codec, endpoints can return it directly to skip `jsonable_encoder`."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -1,7 +1,11 @@
 import configparser
 import os
+import threading
+import time
 
 DEFAULT_CONFIG_FILE = 'config.ini'
+# Seconds between checks of the config file for changes made outside the service
+CONFIG_CHECK_INTERVAL = 1
 
 
 def create_default_config(config_file: str = DEFAULT_CONFIG_FILE):
@@ -12,6 +16,8 @@ def create_default_config(config_file: str = DEFAULT_CONFIG_FILE):
 
     # Add sections and key-value pairs
     config['DEFAULT']['UpdateInterval'] = '30'  # Update interval in minutes
+    config['DEFAULT']['MinUpdateInterval'] = '10'  # Shortest adaptive update interval in minutes
+    config['DEFAULT']['MaxUpdateInterval'] = '360'  # Longest adaptive update interval in minutes
 
     # Write the INI file
     with open(config_file, 'w') as configfile:
@@ -19,38 +25,88 @@ def create_default_config(config_file: str = DEFAULT_CONFIG_FILE):
         print('Config file created:', config_file)
 
 
-def read_config_value(key: str, section: str = 'DEFAULT', config_file: str = DEFAULT_CONFIG_FILE) -> str:
-    # Create a ConfigParser object
-    config = configparser.ConfigParser()
+class Config:
+    """
+    Parsed config file kept in memory.
 
-    # Check if the INI file exists
-    if not os.path.exists(config_file):
-        print('Config file does not exist.')
-        create_default_config(config_file)
+    The file is parsed once and parsed again only when its mtime changes, checked at most every `check_interval`
+    seconds. Writes update the cached values and the file together.
+    """
 
-    # Read the INI file
-    config.read(config_file)
+    def __init__(self, config_file: str = DEFAULT_CONFIG_FILE, check_interval: float = CONFIG_CHECK_INTERVAL):
+        self.config_file: str = config_file
+        self.check_interval: float = check_interval
 
-    # Get a value from the INI file
-    return config[section][key]
+        self.parser: configparser.ConfigParser | None = None
+        self.mtime: float | None = None
+        self.checked: float = 0
 
+        self.lock = threading.Lock()
 
-def write_config_value(key: str, value: str, section: str = 'DEFAULT', config_file: str = DEFAULT_CONFIG_FILE):
-    # Create a ConfigParser object
-    config = configparser.ConfigParser()
+    def load(self):
+        # Check if the INI file exists
+        if not os.path.exists(self.config_file):
+            print('Config file does not exist.')
+            create_default_config(self.config_file)
 
-    # Check if the INI file exists
-    if not os.path.exists(config_file):
-        print('Config file does not exist.')
-        print('Creating a default config file...')
-        create_default_config(config_file)
+        # Read the INI file
+        parser = configparser.ConfigParser()
+        parser.read(self.config_file)
 
-    # Read the INI file
-    config.read(config_file)
+        self.parser = parser
+        self.mtime = os.stat(self.config_file).st_mtime
 
-    # Set a value in the INI file
-    config[section][key] = value
+    def refresh(self):
+        if self.parser is not None and time.time() - self.checked < self.check_interval:
+            return
+        self.checked = time.time()
 
-    # Write the INI file
-    with open(config_file, 'w') as configfile:
-        config.write(configfile)
+        try:
+            mtime = os.stat(self.config_file).st_mtime
+        except FileNotFoundError:
+            mtime = None
+
+        if self.parser is None or mtime != self.mtime:
+            self.load()
+
+    def get(self, key: str, section: str = 'DEFAULT', default: str = None) -> str:
+        with self.lock:
+            self.refresh()
+
+            # Keys added after the config file was created
+            if default is not None and key not in self.parser[section]:
+                return default
+
+            return self.parser[section][key]
+
+    def set(self, key: str, value: str, section: str = 'DEFAULT'):
+        with self.lock:
+            self.refresh()
+
+            # Set a value in the INI file
+            self.parser[section][key] = value
+
+            # Write the INI file
+            with open(self.config_file, 'w') as configfile:
+                self.parser.write(configfile)
+            self.mtime = os.stat(self.config_file).st_mtime
+
+
+configs: dict[str, Config] = {}
+configs_lock = threading.Lock()
+
+
+def get_config(config_file: str = DEFAULT_CONFIG_FILE) -> Config:
+    with configs_lock:
+        if config_file not in configs:
+            configs[config_file] = Config(config_file)
+        return configs[config_file]
+
+
+def read_config_value(key: str, section: str = 'DEFAULT', config_file: str = DEFAULT_CONFIG_FILE,
+                      default: str = None) -> str:
+    return get_config(config_file).get(key, section, default)
+
+
+def write_config_value(key: str, value: str, section: str = 'DEFAULT', config_file: str = DEFAULT_CONFIG_FILE):
+    get_config(config_file).set(key, value, section)
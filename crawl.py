@@ -0,0 +1,59 @@
+"""
+Incremental crawl state of platform queries.
+
+Platform modules with `incremental = True` keep, per query, a compact fingerprint of every product seen: its
+platform id mapped to a hash of its price and availability. Pages are compared against it while they are fetched and
+pagination stops once `unchanged_pages` consecutive pages hold no new or changed product. Every `full_crawl_every`
+runs a query is crawled in full, so goods on the pages past the cutoff are confirmed again.
+
+Pages are fingerprinted when they are fetched, before they are written. An update that fails or is cancelled resets
+the state of its query, so pages that were never written are not skipped by the next runs, which crawl it in full.
+"""
+import os
+import threading
+
+unchanged_pages: int = int(os.getenv('CRAWL_UNCHANGED_PAGES', 2))
+full_crawl_every: int = int(os.getenv('CRAWL_FULL_EVERY', 10))
+
+
+class QueryCrawl:
+    def __init__(self):
+        self.fingerprints: dict[int, int] = {}
+        self.runs: int = 0
+
+    def start_run(self, full_every: int) -> bool:
+        """Count a run, returns True if it has to be a full crawl."""
+        # Nothing to compare against on the first run
+        full = not self.fingerprints or self.runs % full_every == 0
+        self.runs += 1
+        return full
+
+    def update(self, products: [dict]) -> int:
+        """Remember the products of a page, returns how many of them are new or changed."""
+        changed = 0
+        for product in products:
+            platform_id = int(product['id'])
+            fingerprint = hash((str(product['price']), bool(product['in_stock'])))
+
+            if self.fingerprints.get(platform_id) != fingerprint:
+                self.fingerprints[platform_id] = fingerprint
+                changed += 1
+
+        return changed
+
+
+crawls: dict[(str, str), QueryCrawl] = {}
+lock = threading.Lock()
+
+
+def get_crawl(platform: str, query: str) -> QueryCrawl:
+    with lock:
+        if (platform, query) not in crawls:
+            crawls[(platform, query)] = QueryCrawl()
+        return crawls[(platform, query)]
+
+
+def reset_crawl(platform: str, query: str):
+    """Forget the fingerprints of a query, its next run is a full crawl."""
+    with lock:
+        crawls.pop((platform, query), None)
@@ -1,32 +1,175 @@
+import asyncio
+import contextvars
+import functools
 import os
+import queue
 import sqlite3
 import threading
-from typing import Sequence
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Sequence, Callable, Any
 
 import mysql.connector
 from mysql.connector.abstracts import MySQLConnectionAbstract
-from mysql.connector.pooling import PooledMySQLConnection
+from mysql.connector.pooling import PooledMySQLConnection, MySQLConnectionPool, CNX_POOL_MAXSIZE
+
+import metrics
+import migrations
+import profiling
+import refresh
+
+GOODS_IDENTITY_MAP_SIZE = 200_000
+
+# History storage modes: 'full' appends a row on every run, 'delta' only when the value changes
+HISTORY_MODES = ('full', 'delta')
+
+MYSQL_POOL_SIZE = 8
+
+SQLITE_READERS = 4
+ASYNC_DB_WORKERS = 8
+SQLITE_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA mmap_size = 268435456',  # 256 MB
+    'PRAGMA cache_size = -65536',  # 64 MB
+)
+
+# Tables counted for the service statistics
+COUNTED_TABLES = ('tracked_queries', 'goods', 'prices', 'in_stock', 'schedules')
+
+# Longest text values of the goods columns
+PRODUCT_TEXT_LENGTHS = {'name': 512, 'href': 2048, 'img_href': 2048, 'brand': 255}
+# Prices are DECIMAL(10, 2)
+MAX_PRICE = 10 ** 8
+
+
+def product_error(product: dict) -> str | None:
+    """Why a fetched product can't be written, None if it can."""
+    if not isinstance(product, dict):
+        return 'not a product'
+
+    missing = [key for key in ('id', 'price', 'in_stock', *PRODUCT_TEXT_LENGTHS) if key not in product]
+    if missing:
+        return f'missing {", ".join(missing)}'
+
+    try:
+        platform_id = int(product['id'])
+    except (TypeError, ValueError):
+        return f'invalid id: {product["id"]!r}'
+
+    if not 0 <= platform_id < 2 ** 64:
+        return f'invalid id: {platform_id}'
+
+    for column in PRODUCT_TEXT_LENGTHS:
+        value = product[column]
+        if value is None and column in ('name', 'href'):
+            return f'missing {column}'
+        if value is not None and len(str(value)) > PRODUCT_TEXT_LENGTHS[column]:
+            return f'{column} longer than {PRODUCT_TEXT_LENGTHS[column]} characters'
+
+    price = product['price']
+    if price:
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            return f'invalid price: {price!r}'
+        if not -MAX_PRICE < price < MAX_PRICE:
+            return f'invalid price: {price}'
+
+    return None
+
+
+def operation_name(work: Callable) -> str:
+    """Name of the DB method a unit of write work belongs to, e.g. DB.ingest_snapshot.<locals>.ingest."""
+    return work.__qualname__.split('.<locals>')[0].split('.')[-1]
+
+
+class GoodsIdentityMap:
+    """Bounded LRU map of (platform, platform_id, query_id) to goods.id."""
+
+    def __init__(self, max_size: int = GOODS_IDENTITY_MAP_SIZE):
+        self.max_size: int = max_size
+        self.ids: OrderedDict[(str, int, int), int] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, platform: str, platform_id: int, query_id: int) -> int | None:
+        key = (platform, int(platform_id), query_id)
+        with self.lock:
+            good_id = self.ids.get(key)
+            if good_id is not None:
+                self.ids.move_to_end(key)
+            return good_id
+
+    def put(self, platform: str, platform_id: int, query_id: int, good_id: int):
+        key = (platform, int(platform_id), query_id)
+        with self.lock:
+            self.ids[key] = good_id
+            self.ids.move_to_end(key)
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+    def put_many(self, platform: str, query_id: int, rows: [(int, int)]):
+        for platform_id, good_id in rows:
+            self.put(platform, platform_id, query_id, good_id)
+
+    def __len__(self):
+        return len(self.ids)
 
 
 class DB:
-    def __init__(self, cnx: PooledMySQLConnection | MySQLConnectionAbstract | sqlite3.Connection, database: str,
-                 db_type: str):
-        self.cnx: PooledMySQLConnection | MySQLConnectionAbstract | sqlite3.Connection = cnx
+    def __init__(self, cnx: PooledMySQLConnection | MySQLConnectionAbstract | sqlite3.Connection | None,
+                 database: str, db_type: str, history_mode: str = 'full'):
+        self.cnx: PooledMySQLConnection | MySQLConnectionAbstract | sqlite3.Connection | None = cnx
         self.database: str = database
         self.db_type: str = db_type
 
+        if history_mode not in HISTORY_MODES:
+            raise ValueError(f'Invalid history mode: {history_mode}')
+        self.history_mode: str = history_mode
+
         # Create a lock
         self.lock = threading.Lock()
         self.initialized = False
 
+        # Warm cache of goods ids
+        self.good_ids = GoodsIdentityMap()
+
+    @contextmanager
+    def connection(self):
+        """Yield a connection to run queries on. The shared connection is guarded by the lock."""
+        timer = time.perf_counter()
+        with self.lock:
+            metrics.db_wait_seconds.observe(time.perf_counter() - timer, kind='connection')
+            profiling.record('db.wait', timer, time.perf_counter(), kind='connection')
+            yield self.cnx
+
+    def run_in_transaction(self, work: Callable[[Any], Any]) -> Any:
+        """Run `work(cnx)` on a connection and commit, or roll back if it raises."""
+        operation = operation_name(work)
+        with self.connection() as cnx, metrics.db_write_seconds.time(operation=operation), \
+                profiling.span('db.write', operation=operation):
+            try:
+                result = work(cnx)
+
+                # Make sure data is committed to the database
+                cnx.commit()
+
+                return result
+            except Exception:
+                cnx.rollback()
+                raise
+
     def db_init(self):
         if self.initialized:
             return
 
         print('DB Init...')
-        try:
+
+        def create_tables(cnx):
             # Get a cursor
-            cur = self.cnx.cursor()
+            cur = cnx.cursor()
             print('Cursor created')
 
             if self.db_type == 'mysql':
@@ -120,8 +263,13 @@ class DB:
             '''.format(int='INTEGER' if self.db_type == 'sqlite' else 'INT',
                        auto_increment='AUTOINCREMENT' if self.db_type == 'sqlite' else 'AUTO_INCREMENT'))
 
-            # Make sure data is committed to the database
-            self.cnx.commit()
+            cur.close()
+
+        try:
+            self.run_in_transaction(create_tables)
+
+            # Bring the schema up to date
+            migrations.migrate(self)
 
         except mysql.connector.Error if self.db_type == 'mysql' else sqlite3.Error as e:
             print('DB Init Error:', e)
@@ -130,7 +278,6 @@ class DB:
             print('DB Init successful')
             print('--' * 50)
             print('')
-            cur.close()
             self.initialized = True
 
     def db_close(self):
@@ -144,10 +291,10 @@ class DB:
             print('DB Close Error:', e)
 
     def get_queries(self):
-        with self.lock:
+        with self.connection() as cnx:
             try:
                 # Get a cursor
-                cur = self.cnx.cursor()
+                cur = cnx.cursor()
 
                 # Execute a query
                 cur.execute('SELECT * FROM tracked_queries')
@@ -162,10 +309,10 @@ class DB:
                 return []
 
     def get_active_queries(self):
-        with self.lock:
+        with self.connection() as cnx:
             try:
                 # Get a cursor
-                cur = self.cnx.cursor()
+                cur = cnx.cursor()
 
                 # Execute a query
                 cur.execute('SELECT id,query FROM tracked_queries WHERE active = TRUE')
@@ -180,52 +327,49 @@ class DB:
                 return []
 
     def set_query_status(self, query_id: int, active: bool):
-        with self.lock:
-            try:
-                # Get a cursor
-                cur = self.cnx.cursor()
+        def update(cnx):
+            # Get a cursor
+            cur = cnx.cursor()
 
-                # Execute a query
-                if self.db_type == 'mysql':
-                    cur.execute('UPDATE tracked_queries SET active = %s WHERE id = %s', (active, query_id))
-                elif self.db_type == 'sqlite':
-                    cur.execute('UPDATE tracked_queries SET active = ? WHERE id = ?', (active, query_id))
+            # Execute a query
+            if self.db_type == 'mysql':
+                cur.execute('UPDATE tracked_queries SET active = %s WHERE id = %s', (active, query_id))
+            elif self.db_type == 'sqlite':
+                cur.execute('UPDATE tracked_queries SET active = ? WHERE id = ?', (active, query_id))
 
-                # Make sure data is committed to the database
-                self.cnx.commit()
+            cur.close()
 
-                cur.close()
-            except mysql.connector.Error as e:
-                print('Set Query Status Error:', e)
+        try:
+            self.run_in_transaction(update)
+        except mysql.connector.Error as e:
+            print('Set Query Status Error:', e)
 
     def add_query(self, query: str):
-        with self.lock:
+        def insert(cnx):
+            # Get a cursor
+            cur = cnx.cursor()
             try:
-                # Get a cursor
-                cur = self.cnx.cursor()
-
                 # Execute a query
                 if self.db_type == 'mysql':
                     cur.execute('INSERT INTO tracked_queries (query) VALUES (%s)', (query,))
                 elif self.db_type == 'sqlite':
                     cur.execute('INSERT INTO tracked_queries (query) VALUES (?)', (query,))
 
-                # Make sure data is committed to the database
-                self.cnx.commit()
-
                 return cur.lastrowid
-            except mysql.connector.Error as e:
-                print('Add Query Error:', e)
-                return -1
             finally:
                 cur.close()
 
+        try:
+            return self.run_in_transaction(insert)
+        except mysql.connector.Error as e:
+            print('Add Query Error:', e)
+            return -1
+
     def execute_query(self, query: str, last_row_id=False, params: Sequence = ()):
-        with self.lock:
+        def execute(cnx):
+            # Get a cursor
+            cur = cnx.cursor()
             try:
-                # Get a cursor
-                cur = self.cnx.cursor()
-
                 # Execute a query
                 cur.execute(query, params)
 
@@ -233,19 +377,20 @@ class DB:
                     return cur.lastrowid
 
                 return cur.fetchall()
-
-            except mysql.connector.Error as e:
-                print('Execute Query Error:', e)
-                raise e
             finally:
-                # Make sure data is committed to the database
-                self.cnx.commit()
+                cur.close()
+
+        try:
+            return self.run_in_transaction(execute)
+        except mysql.connector.Error as e:
+            print('Execute Query Error:', e)
+            raise e
 
     def get_goods(self):
-        with self.lock:
+        with self.connection() as cnx:
             try:
                 # Get a cursor
-                cur = self.cnx.cursor()
+                cur = cnx.cursor()
 
                 # Execute a query
                 cur.execute('SELECT * FROM goods')
@@ -259,20 +404,98 @@ class DB:
                 print('Get Goods Error:', e)
                 return []
 
-    def get_prices(self, good_id: int):
-        with self.lock:
+    def count_rows(self, tables: [str] = COUNTED_TABLES) -> dict[str, int]:
+        """Number of rows of each table."""
+        counts = {}
+        with self.connection() as cnx:
+            try:
+                cur = cnx.cursor()
+                for table in tables:
+                    cur.execute(f'SELECT COUNT(*) FROM {table}')
+                    counts[table] = cur.fetchone()[0]
+                cur.close()
+
+            except (mysql.connector.Error, sqlite3.Error) as e:
+                print('Count Rows Error:', e)
+
+        return counts
+
+    def count_goods_per_query(self) -> dict[(str, int), int]:
+        """Number of goods of each (platform, query) pair."""
+        with self.connection() as cnx:
+            try:
+                cur = cnx.cursor()
+                cur.execute('SELECT platform, query_id, COUNT(*) FROM goods GROUP BY platform, query_id')
+                rows = cur.fetchall()
+                cur.close()
+
+                return {(platform, query_id): count for platform, query_id, count in rows}
+            except (mysql.connector.Error, sqlite3.Error) as e:
+                print('Count Goods Error:', e)
+                return {}
+
+    def get_goods_page(self, platform: str = None, query_id: int = None, brand: str = None,
+                       updated_since: str = None, after_id: int = None, limit: int = 100,
+                       with_total: bool = False) -> (list, bool, int | None):
+        """
+        Return one keyset page of goods ordered by id.
+
+        Returns the rows, whether there is a next page and, if requested, the total count of goods
+        matching the filters.
+        """
+        p = '%s' if self.db_type == 'mysql' else '?'
+        conditions = []
+        params = []
+
+        for condition, value in ((f'platform = {p}', platform), (f'query_id = {p}', query_id),
+                                 (f'brand = {p}', brand), (f'last_updated >= {p}', updated_since)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+
+        where = ' AND '.join(conditions) if conditions else '1 = 1'
+
+        with self.connection() as cnx:
             try:
                 # Get a cursor
-                cur = self.cnx.cursor()
+                cur = cnx.cursor()
 
-                # Execute a query
-                if self.db_type == 'mysql':
-                    cur.execute('SELECT price,timestamp FROM prices WHERE good_id = %s', (good_id,))
-                elif self.db_type == 'sqlite':
-                    cur.execute('SELECT price,timestamp FROM prices WHERE good_id = ?', (good_id,))
+                total = None
+                if with_total:
+                    cur.execute(f'SELECT COUNT(*) FROM goods WHERE {where}', params)
+                    total = cur.fetchone()[0]
+
+                # Fetch one extra row to know if there is a next page
+                if after_id is not None:
+                    cur.execute(f'SELECT * FROM goods WHERE {where} AND id > {p} ORDER BY id LIMIT {p}',
+                                params + [after_id, limit + 1])
+                else:
+                    cur.execute(f'SELECT * FROM goods WHERE {where} ORDER BY id LIMIT {p}', params + [limit + 1])
 
-                # Fetch all results
                 rows = cur.fetchall()
+                cur.close()
+
+                return rows[:limit], len(rows) > limit, total
+
+            except mysql.connector.Error as e:
+                print('Get Goods Page Error:', e)
+                return [], False, None
+
+    def get_prices(self, good_id: int, start: str = None, end: str = None, bucket: int = None):
+        """
+        Return the price history of a good as (price, timestamp) rows, optionally limited to [start, end).
+
+        With `bucket` (seconds) the history is aggregated into (bucket_start, min, max, avg, last, samples)
+        rows, in SQL in full mode and weighted by time over the step function in delta mode.
+        """
+        with self.connection() as cnx:
+            try:
+                # Get a cursor
+                cur = cnx.cursor()
+
+                # Execute a query
+                rows = self._fetch_history(cur, 'prices', 'price', good_id, start, end, bucket)
+
                 cur.close()
                 return rows
 
@@ -280,20 +503,21 @@ class DB:
                 print('Get Prices Error:', e)
                 return []
 
-    def get_in_stock(self, good_id: int):
-        with self.lock:
+    def get_in_stock(self, good_id: int, start: str = None, end: str = None, bucket: int = None):
+        """
+        Return the stock status history of a good as (in_stock, timestamp) rows, optionally limited to [start, end).
+
+        With `bucket` (seconds) the history is aggregated into (bucket_start, fraction_in_stock, last, samples)
+        rows, in SQL in full mode and weighted by time over the step function in delta mode.
+        """
+        with self.connection() as cnx:
             try:
                 # Get a cursor
-                cur = self.cnx.cursor()
+                cur = cnx.cursor()
 
                 # Execute a query
-                if self.db_type == 'mysql':
-                    cur.execute('SELECT in_stock,timestamp FROM in_stock WHERE good_id = %s', (good_id,))
-                elif self.db_type == 'sqlite':
-                    cur.execute('SELECT in_stock,timestamp FROM in_stock WHERE good_id = ?', (good_id,))
+                rows = self._fetch_history(cur, 'in_stock', 'in_stock', good_id, start, end, bucket)
 
-                # Fetch all results
-                rows = cur.fetchall()
                 cur.close()
                 return rows
 
@@ -301,35 +525,231 @@ class DB:
                 print('Get In Stock Error:', e)
                 return []
 
-    def get_good_id(self, platform_id: int, query_id: int):
-        with self.lock:
+    def get_prices_batch(self, good_ids: [int], start: str = None, end: str = None) -> dict:
+        """Return the price history of many goods with one ordered query, grouped by good id."""
+        with self.connection() as cnx:
             try:
                 # Get a cursor
-                cur = self.cnx.cursor()
+                cur = cnx.cursor()
+
+                # Execute a query
+                history = self._fetch_history_batch(cur, 'prices', 'price', good_ids, start, end)
+
+                cur.close()
+                return history
+
+            except mysql.connector.Error as e:
+                print('Get Prices Batch Error:', e)
+                return {}
+
+    def get_in_stock_batch(self, good_ids: [int], start: str = None, end: str = None) -> dict:
+        """Return the stock status history of many goods with one ordered query, grouped by good id."""
+        with self.connection() as cnx:
+            try:
+                # Get a cursor
+                cur = cnx.cursor()
+
+                # Execute a query
+                history = self._fetch_history_batch(cur, 'in_stock', 'in_stock', good_ids, start, end)
+
+                cur.close()
+                return history
+
+            except mysql.connector.Error as e:
+                print('Get In Stock Batch Error:', e)
+                return {}
+
+    def _fetch_history_batch(self, cur, table: str, column: str, good_ids: [int], start: str = None,
+                             end: str = None) -> dict:
+        p = '%s' if self.db_type == 'mysql' else '?'
+        good_ids = list(dict.fromkeys(good_ids))
+        history = {good_id: [] for good_id in good_ids}
+
+        # Keep the number of bound parameters under the SQLite limit
+        for i in range(0, len(good_ids), 500):
+            chunk = good_ids[i:i + 500]
+            where = f'good_id IN ({", ".join([p] * len(chunk))})'
+            params = list(chunk)
+
+            # The value held at the start of the range is the last change point before it
+            held = {}
+            if self.history_mode == 'delta' and start:
+                cur.execute(f'''
+                    SELECT good_id, value FROM (
+                        SELECT good_id, {column} AS value,
+                               ROW_NUMBER() OVER (PARTITION BY good_id ORDER BY timestamp DESC, id DESC) AS n
+                        FROM {table} WHERE {where} AND timestamp < {p}
+                    ) held WHERE n = 1
+                ''', params + [start])
+                held = dict(cur.fetchall())
+
+            if start:
+                where += f' AND timestamp >= {p}'
+                params.append(start)
+            if end:
+                where += f' AND timestamp < {p}'
+                params.append(end)
+
+            cur.execute(f'SELECT good_id,{column},timestamp FROM {table} WHERE {where} ORDER BY good_id, timestamp, id',
+                        params)
+            for good_id, value, timestamp in cur.fetchall():
+                history[good_id].append((value, timestamp))
+
+            if self.history_mode == 'delta':
+                cur.execute(f'SELECT id, last_confirmed FROM goods WHERE id IN ({", ".join([p] * len(chunk))})', chunk)
+                for good_id, last_confirmed in cur.fetchall():
+                    history[good_id] = self._step_range(history[good_id], held.get(good_id), last_confirmed, start,
+                                                        end)
+
+        return history
+
+    def _step_range(self, rows: list, held: Any, last_confirmed: Any, start: str = None, end: str = None) -> list:
+        """
+        Rebuild the step function of a delta series over [start, end) from the change points inside the range.
+
+        The series starts with the value `held` before the range, at `start`, and the last value is carried forward
+        to `goods.last_confirmed`, clamped to `end`.
+        """
+        start = self._row_time(start) if start else None
+        end = self._row_time(end) if end else None
+
+        # Not seen since before the range
+        if start and last_confirmed and last_confirmed < start:
+            return []
+
+        if held is not None and not (rows and rows[0][1] == start):
+            rows = [(held, start)] + rows
+
+        tail = min(last_confirmed, end) if last_confirmed and end else last_confirmed
+        if rows and tail and tail > rows[-1][1]:
+            rows = rows + [(rows[-1][0], tail)]
+
+        return rows
+
+    def _row_time(self, timestamp: str) -> str | datetime:
+        # SQLite returns timestamps as strings, MySQL as datetimes
+        if self.db_type == 'mysql':
+            return datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        return timestamp
+
+    def _fetch_history(self, cur, table: str, column: str, good_id: int, start: str = None, end: str = None,
+                       bucket: int = None) -> list:
+        if self.history_mode == 'delta':
+            # Rows are only stored on changes, buckets are aggregated over the rebuilt step function
+            rows = self._fetch_history_batch(cur, table, column, [good_id], start, end)[good_id]
+            return self._bucket_steps(rows, column, int(bucket)) if bucket else rows
+
+        p = '%s' if self.db_type == 'mysql' else '?'
+        where = f'good_id = {p}'
+        params = [good_id]
+
+        if start:
+            where += f' AND timestamp >= {p}'
+            params.append(start)
+        if end:
+            where += f' AND timestamp < {p}'
+            params.append(end)
+
+        if not bucket:
+            cur.execute(f'SELECT {column},timestamp FROM {table} WHERE {where} ORDER BY timestamp, id', params)
+            return cur.fetchall()
+
+        # Aggregate into time buckets
+        bucket = int(bucket)
+        if self.db_type == 'mysql':
+            bucket_start = f'FLOOR(UNIX_TIMESTAMP(timestamp) / {bucket}) * {bucket}'
+        else:
+            bucket_start = f"(CAST(strftime('%s', timestamp) AS INTEGER) / {bucket}) * {bucket}"
+
+        if column == 'price':
+            aggregates = 'MIN(value), MAX(value), AVG(value)'
+        else:
+            aggregates = 'AVG(CASE WHEN value THEN 1.0 ELSE 0.0 END)'
+
+        cur.execute(f'''
+            SELECT bucket_start, {aggregates}, MAX(last_value), COUNT(*) FROM (
+                SELECT {bucket_start} AS bucket_start, {column} AS value,
+                       FIRST_VALUE({column}) OVER (PARTITION BY {bucket_start} ORDER BY timestamp DESC, id DESC)
+                       AS last_value
+                FROM {table} WHERE {where}
+            ) history GROUP BY bucket_start ORDER BY bucket_start
+        ''', params)
+
+        return [(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(row[0]))),) + tuple(row[1:])
+                for row in cur.fetchall()]
+
+    def get_good_id(self, platform_id: int, query_id: int, platform: str = None):
+        if platform:
+            good_id = self.good_ids.get(platform, platform_id, query_id)
+            if good_id is not None:
+                return [(good_id,)]
+
+        with self.connection() as cnx:
+            try:
+                # Get a cursor
+                cur = cnx.cursor()
 
                 # Execute a query
                 if self.db_type == 'mysql':
-                    cur.execute('SELECT id FROM goods WHERE platform_id = %d AND query_id = %s',
-                                (platform_id, query_id))
+                    query = 'SELECT id FROM goods WHERE platform_id = %s AND query_id = %s'
+                    params = (platform_id, query_id)
+                    if platform:
+                        query += ' AND platform = %s'
+                        params += (platform,)
+                    cur.execute(query, params)
                 elif self.db_type == 'sqlite':
-                    cur.execute('SELECT id FROM goods WHERE platform_id = ? AND query_id = ?', (platform_id, query_id))
+                    query = 'SELECT id FROM goods WHERE platform_id = ? AND query_id = ?'
+                    params = (platform_id, query_id)
+                    if platform:
+                        query += ' AND platform = ?'
+                        params += (platform,)
+                    cur.execute(query, params)
 
                 # Fetch all results
                 rows = cur.fetchall()
                 cur.close()
+
+                if platform and rows:
+                    self.good_ids.put(platform, platform_id, query_id, rows[0][0])
+
                 return rows
 
             except mysql.connector.Error as e:
                 print('Get Good ID Error:', e)
                 return []
 
-    def add_good(self, platform: str, platform_id: int, query_id: int, name: str, href: str, img_href: str,
-                 brand: str) -> int:
-        with self.lock:
+    def warm_good_ids(self, platform: str, query_id: int) -> int:
+        """Load ids of all goods of a platform and query into the identity map."""
+        with self.connection() as cnx:
             try:
                 # Get a cursor
-                cur = self.cnx.cursor()
+                cur = cnx.cursor()
+
+                # Execute a query
+                if self.db_type == 'mysql':
+                    cur.execute('SELECT platform_id, id FROM goods WHERE platform = %s AND query_id = %s',
+                                (platform, query_id))
+                elif self.db_type == 'sqlite':
+                    cur.execute('SELECT platform_id, id FROM goods WHERE platform = ? AND query_id = ?',
+                                (platform, query_id))
+
+                # Fetch all results
+                rows = cur.fetchall()
+                cur.close()
+
+                self.good_ids.put_many(platform, query_id, rows)
+                return len(rows)
 
+            except mysql.connector.Error as e:
+                print('Warm Good IDs Error:', e)
+                return 0
+
+    def add_good(self, platform: str, platform_id: int, query_id: int, name: str, href: str, img_href: str,
+                 brand: str) -> int:
+        def insert(cnx):
+            # Get a cursor
+            cur = cnx.cursor()
+            try:
                 # Execute a query
                 if self.db_type == 'mysql':
                     cur.execute('''
@@ -342,21 +762,27 @@ class DB:
                         ?, ?, ?, ?, ?, ?, ?)
                     ''', (platform, platform_id, query_id, name, href, img_href, brand))
 
-                # Make sure data is committed to the database
-                self.cnx.commit()
-
                 return cur.lastrowid
-            except mysql.connector.Error as e:
-                print('Insert Good Error:', e)
-                return -1
             finally:
                 cur.close()
 
+        try:
+            good_id = self.run_in_transaction(insert)
+            self.good_ids.put(platform, platform_id, query_id, good_id)
+            return good_id
+        except mysql.connector.Error as e:
+            print('Insert Good Error:', e)
+            return -1
+
     def add_price(self, good_id: int, price: float) -> int:
-        with self.lock:
+        def insert(cnx):
+            # Get a cursor
+            cur = cnx.cursor()
             try:
-                # Get a cursor
-                cur = self.cnx.cursor()
+                # Skip unchanged values in delta mode
+                if self.history_mode == 'delta' and self._same_value(
+                        'price', self._last_values(cur, 'prices', 'price', (good_id,)).get(good_id), price):
+                    return 0
 
                 # Execute a query
                 if self.db_type == 'mysql':
@@ -364,21 +790,25 @@ class DB:
                 elif self.db_type == 'sqlite':
                     cur.execute('INSERT INTO prices (good_id, price) VALUES (?, ?)', (good_id, price))
 
-                # Make sure data is committed to the database
-                self.cnx.commit()
-
                 return cur.lastrowid
-            except mysql.connector.Error as e:
-                print('Insert Price Error:', e)
-                return -1
             finally:
                 cur.close()
 
+        try:
+            return self.run_in_transaction(insert)
+        except mysql.connector.Error as e:
+            print('Insert Price Error:', e)
+            return -1
+
     def add_in_stock(self, good_id: int, in_stock: bool) -> int:
-        with self.lock:
+        def insert(cnx):
+            # Get a cursor
+            cur = cnx.cursor()
             try:
-                # Get a cursor
-                cur = self.cnx.cursor()
+                # Skip unchanged values in delta mode
+                if self.history_mode == 'delta' and self._same_value(
+                        'in_stock', self._last_values(cur, 'in_stock', 'in_stock', (good_id,)).get(good_id), in_stock):
+                    return 0
 
                 # Execute a query
                 if self.db_type == 'mysql':
@@ -386,93 +816,632 @@ class DB:
                 elif self.db_type == 'sqlite':
                     cur.execute('INSERT INTO in_stock (good_id, in_stock) VALUES (?, ?)', (good_id, in_stock))
 
-                # Make sure data is committed to the database
-                self.cnx.commit()
-
                 return cur.lastrowid
-            except mysql.connector.Error as e:
-                print('Insert In Stock Error:', e)
-                return -1
             finally:
                 cur.close()
 
+        try:
+            return self.run_in_transaction(insert)
+        except mysql.connector.Error as e:
+            print('Insert In Stock Error:', e)
+            return -1
+
     def update_last_confirmed(self, good_id: int, last_confirmed: str) -> int:
-        with self.lock:
+        def update(cnx):
+            # Get a cursor
+            cur = cnx.cursor()
             try:
-                # Get a cursor
-                cur = self.cnx.cursor()
-
                 # Execute a query
                 if self.db_type == 'mysql':
                     cur.execute('UPDATE goods SET last_confirmed = %s WHERE id = %s', (last_confirmed, good_id))
                 elif self.db_type == 'sqlite':
                     cur.execute('UPDATE goods SET last_confirmed = ? WHERE id = ?', (last_confirmed, good_id))
 
-                # Make sure data is committed to the database
-                self.cnx.commit()
-
                 return cur.lastrowid
-            except mysql.connector.Error as e:
-                print('Update Last Confirmed Error:', e)
-                return -1
             finally:
                 cur.close()
 
+        try:
+            return self.run_in_transaction(update)
+        except mysql.connector.Error as e:
+            print('Update Last Confirmed Error:', e)
+            return -1
+
+    def ingest_snapshot(self, platform: str, query_id: int, products: [dict], timestamp: float) -> dict:
+        """
+        Write a whole fetched result set in one transaction.
+
+        Skips malformed products, then resolves goods ids, inserts unknown goods, appends prices and stock statuses and
+        updates `last_confirmed` with batched `executemany` statements and a single commit.
+        Returns ingest statistics (row counts, goods seen before and how many of them have a changed price or stock
+        status, duration and rows/s).
+        """
+        p = '%s' if self.db_type == 'mysql' else '?'
+        confirmed_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+        stats = {'products': len(products), 'skipped': 0, 'new_goods': 0, 'prices': 0, 'in_stock': 0, 'changes': 0,
+                 'known': 0, 'rows': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+
+        # Skip malformed products before the transaction, one of them would roll back the whole batch
+        products_by_id = {}
+        for product in products:
+            error = product_error(product)
+            if error:
+                print('Skipping product', product.get('id') if isinstance(product, dict) else product, 'error:', error)
+                stats['skipped'] += 1
+                continue
+
+            # The same product may appear on several pages, keep the first occurrence like the worker
+            products_by_id.setdefault(int(product['id']), product)
+        if not products_by_id:
+            return stats
+
+        def ingest(cnx):
+            cur = cnx.cursor()
+            try:
+                # Resolve ids of goods already known for this platform and query
+                good_ids = {platform_id: self.good_ids.get(platform, platform_id, query_id)
+                            for platform_id in products_by_id}
+                if None in good_ids.values():
+                    cur.execute(f'SELECT platform_id, id FROM goods WHERE platform = {p} AND query_id = {p}',
+                                (platform, query_id))
+                    rows = cur.fetchall()
+                    self.good_ids.put_many(platform, query_id, rows)
+                    good_ids.update((int(platform_id), good_id) for platform_id, good_id in rows
+                                    if int(platform_id) in products_by_id)
+
+                # Insert unknown goods
+                new_goods = [(platform, platform_id, query_id, product['name'], product['href'], product['img_href'],
+                              product['brand'])
+                             for platform_id, product in products_by_id.items() if good_ids[platform_id] is None]
+                if new_goods:
+                    cur.executemany(f'''
+                        INSERT INTO goods (platform, platform_id, query_id, name, href, img_href, brand) VALUES (
+                        {p}, {p}, {p}, {p}, {p}, {p}, {p})
+                    ''', new_goods)
+
+                    cur.execute(f'SELECT platform_id, id FROM goods WHERE platform = {p} AND query_id = {p}',
+                                (platform, query_id))
+                    rows = cur.fetchall()
+                    good_ids.update((int(platform_id), good_id) for platform_id, good_id in rows
+                                    if int(platform_id) in products_by_id)
+
+                # Add prices, stock statuses and confirm goods
+                prices = [(good_ids[platform_id], product['price'], confirmed_at)
+                          for platform_id, product in products_by_id.items() if product['price']]
+                in_stock = [(good_ids[platform_id], bool(product['in_stock']), confirmed_at)
+                            for platform_id, product in products_by_id.items()]
+                confirmed = [(confirmed_at, good_ids[platform_id]) for platform_id in products_by_id]
+
+                # Values that differ from the latest stored ones
+                ids = [good_ids[platform_id] for platform_id in products_by_id]
+                last_prices = self._last_values(cur, 'prices', 'price', ids)
+                last_in_stock = self._last_values(cur, 'in_stock', 'in_stock', ids)
+                changed_prices = [row for row in prices
+                                  if not self._same_value('price', last_prices.get(row[0]), row[1])]
+                changed_in_stock = [row for row in in_stock
+                                    if not self._same_value('in_stock', last_in_stock.get(row[0]), row[1])]
+                # Goods seen before, first-seen goods are not changes
+                known = {good_id for good_id in ids if good_id in last_prices or good_id in last_in_stock}
+                changes = len(({row[0] for row in changed_prices} | {row[0] for row in changed_in_stock}) & known)
+
+                if self.history_mode == 'delta':
+                    # Only write values that differ from the latest stored ones
+                    prices = changed_prices
+                    in_stock = changed_in_stock
+
+                if prices:
+                    cur.executemany(f'INSERT INTO prices (good_id, price, timestamp) VALUES ({p}, {p}, {p})', prices)
+                if in_stock:
+                    cur.executemany(f'INSERT INTO in_stock (good_id, in_stock, timestamp) VALUES ({p}, {p}, {p})',
+                                    in_stock)
+                cur.executemany(f'UPDATE goods SET last_confirmed = {p} WHERE id = {p}', confirmed)
+
+                return good_ids, new_goods, prices, in_stock, confirmed, changes, len(known)
+            finally:
+                cur.close()
+
+        timer = time.time()
+
+        try:
+            good_ids, new_goods, prices, in_stock, confirmed, changes, known = self.run_in_transaction(ingest)
+        except (mysql.connector.Error, sqlite3.Error) as e:
+            print('Ingest Snapshot Error:', e)
+            raise e
+
+        metrics.db_rows_inserted.inc(len(new_goods), table='goods')
+        metrics.db_rows_inserted.inc(len(prices), table='prices')
+        metrics.db_rows_inserted.inc(len(in_stock), table='in_stock')
+
+        # Only remember new goods once they are committed
+        if new_goods:
+            self.good_ids.put_many(platform, query_id, ((good[1], good_ids[good[1]]) for good in new_goods))
+
+        stats['new_goods'] = len(new_goods)
+        stats['prices'] = len(prices)
+        stats['in_stock'] = len(in_stock)
+        stats['changes'] = changes
+        stats['known'] = known
+        stats['rows'] = len(new_goods) + len(prices) + len(in_stock) + len(confirmed)
+        stats['seconds'] = round(time.time() - timer, 3)
+        stats['rows_per_second'] = round(stats['rows'] / stats['seconds'], 1) if stats['seconds'] else 0.0
+
+        return stats
+
+    def _last_values(self, cur, table: str, column: str, good_ids: [int]) -> dict:
+        """Return the latest stored value of a history table for each of the given goods."""
+        p = '%s' if self.db_type == 'mysql' else '?'
+        last_values = {}
+
+        # Keep the number of bound parameters under the SQLite limit
+        for i in range(0, len(good_ids), 500):
+            chunk = good_ids[i:i + 500]
+            # The order of the (good_id, timestamp, value) index, each lookup reads one index entry instead of the
+            # whole history of the good
+            cur.execute(f'''
+                SELECT g.id, (SELECT h.{column} FROM {table} h WHERE h.good_id = g.id
+                              ORDER BY h.timestamp DESC, h.{column} DESC, h.id DESC LIMIT 1)
+                FROM goods g WHERE g.id IN ({', '.join([p] * len(chunk))})
+            ''', chunk)
+            last_values.update((good_id, value) for good_id, value in cur.fetchall() if value is not None)
+
+        return last_values
+
+    @staticmethod
+    def _same_value(column: str, last_value, value) -> bool:
+        if last_value is None:
+            return False
+
+        if column == 'price':
+            return round(float(last_value), 2) == round(float(value), 2)
+
+        return bool(last_value) == bool(value)
+
+    @staticmethod
+    def _bucket_steps(rows: list, column: str, bucket: int) -> list:
+        """
+        Aggregate a step function series into time buckets, with the rows of the SQL aggregation in full mode.
+
+        Every value is weighted by the time it was held within the bucket, e.g. an in stock fraction of 0.25 means in
+        stock for a quarter of the bucket the series covers.
+        """
+        points = [(refresh.from_db_time(timestamp), value) for value, timestamp in rows]
+
+        # Bucket start -> [values, time weighted sum, seconds, last value, samples]
+        buckets = {}
+        for i, (held_from, value) in enumerate(points):
+            number = float(value) if column == 'price' else (1.0 if value else 0.0)
+            held_until = points[i + 1][0] if i + 1 < len(points) else held_from
+
+            # The end of the series is held for no time, e.g. at the exclusive end of the range it opens no bucket
+            if i and held_until == held_from and int(held_from // bucket) * bucket not in buckets:
+                continue
+
+            segment_start = held_from
+            samples = 1
+            while True:
+                bucket_start = int(segment_start // bucket) * bucket
+                segment_end = min(held_until, bucket_start + bucket)
+
+                aggregate = buckets.setdefault(bucket_start, [[], 0.0, 0.0, None, 0])
+                aggregate[0].append(number)
+                aggregate[1] += number * (segment_end - segment_start)
+                aggregate[2] += segment_end - segment_start
+                aggregate[3] = value
+                aggregate[4] += samples
+
+                if segment_end >= held_until:
+                    break
+                segment_start = segment_end
+                samples = 0
+
+        result = []
+        for bucket_start, (numbers, weighted, seconds, last, samples) in sorted(buckets.items()):
+            average = weighted / seconds if seconds else sum(numbers) / len(numbers)
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(bucket_start))
+            if column == 'price':
+                result.append((timestamp, min(numbers), max(numbers), average, last, samples))
+            else:
+                result.append((timestamp, average, last, samples))
+
+        return result
+
+    def compact_history(self) -> dict:
+        """
+        One-off migration to delta storage.
+
+        Deletes rows of `prices` and `in_stock` that repeat the previous value of the same good.
+        The step-function series stays the same, `goods.last_confirmed` carries the tail.
+        """
+        print('Compacting history...')
+
+        def compact(cnx):
+            deleted = {}
+            cur = cnx.cursor()
+            try:
+                for table, column in (('prices', 'price'), ('in_stock', 'in_stock')):
+                    cur.execute(f'''
+                        DELETE FROM {table} WHERE id IN (
+                            SELECT id FROM (
+                                SELECT id, {column} AS value,
+                                       LAG({column}) OVER (PARTITION BY good_id ORDER BY timestamp, id) AS previous
+                                FROM {table}
+                            ) history WHERE previous = value
+                        )
+                    ''')
+                    deleted[table] = cur.rowcount
+                    print(f'{table}: {cur.rowcount} duplicate rows deleted')
+
+                return deleted
+            finally:
+                cur.close()
+
+        try:
+            deleted = self.run_in_transaction(compact)
+        except (mysql.connector.Error, sqlite3.Error) as e:
+            print('Compact History Error:', e)
+            raise e
+
+        print('History compacted')
+        return deleted
+
+    def get_schedules(self) -> [tuple]:
+        """Refresh schedules as (platform, query_id, interval_minutes, pinned, next_run, last_run, last_changes)."""
+        with self.connection() as cnx:
+            try:
+                cur = cnx.cursor()
+                cur.execute('''
+                    SELECT platform, query_id, interval_minutes, pinned, next_run, last_run, last_changes FROM schedules
+                    ORDER BY platform, query_id
+                ''')
+                rows = cur.fetchall()
+                cur.close()
+
+                return rows
+            except (mysql.connector.Error, sqlite3.Error) as e:
+                print('Get Schedules Error:', e)
+                return []
+
+    def add_schedules(self, platforms: [str], query_ids: [int], interval: int) -> int:
+        """Add missing schedules of (platform, query) pairs, due at once. Returns the number of added schedules."""
+        p = '%s' if self.db_type == 'mysql' else '?'
+        rows = [(platform, query_id, interval) for platform in platforms for query_id in query_ids]
+
+        def insert(cnx):
+            cur = cnx.cursor()
+            try:
+                if self.db_type == 'mysql':
+                    cur.executemany(f'INSERT IGNORE INTO schedules (platform, query_id, interval_minutes) '
+                                    f'VALUES ({p}, {p}, {p})', rows)
+                elif self.db_type == 'sqlite':
+                    cur.executemany(f'INSERT OR IGNORE INTO schedules (platform, query_id, interval_minutes) '
+                                    f'VALUES ({p}, {p}, {p})', rows)
+
+                return cur.rowcount
+            finally:
+                cur.close()
+
+        if not rows:
+            return 0
+
+        try:
+            return self.run_in_transaction(insert)
+        except (mysql.connector.Error, sqlite3.Error) as e:
+            print('Add Schedules Error:', e)
+            return -1
+
+    def get_due_schedules(self, now: str, platforms: [str]) -> [(str, int, int, bool)]:
+        """
+        Schedules of active queries on the given platforms due at `now`, as (platform, query_id, interval_minutes,
+        pinned).
+
+        Schedules of deactivated queries and of platforms that are not loaded are never run, they are left out so
+        they don't keep an update run due.
+        """
+        p = '%s' if self.db_type == 'mysql' else '?'
+        if not platforms:
+            return []
+
+        with self.connection() as cnx:
+            try:
+                cur = cnx.cursor()
+                cur.execute(f'''
+                    SELECT s.platform, s.query_id, s.interval_minutes, s.pinned FROM schedules s
+                    JOIN tracked_queries q ON q.id = s.query_id AND q.active = TRUE
+                    WHERE (s.next_run IS NULL OR s.next_run <= {p})
+                    AND s.platform IN ({", ".join([p] * len(platforms))})
+                ''', (now, *platforms))
+                rows = cur.fetchall()
+                cur.close()
+
+                return rows
+            except (mysql.connector.Error, sqlite3.Error) as e:
+                print('Get Due Schedules Error:', e)
+                return []
+
+    def update_schedule(self, platform: str, query_id: int, next_run: str, interval: int = None,
+                        last_run: str = None, last_changes: int = None) -> int:
+        """Set the next run of a schedule, and its interval and last run outcome when given."""
+        p = '%s' if self.db_type == 'mysql' else '?'
+        columns = {'next_run': next_run, 'interval_minutes': interval, 'last_run': last_run,
+                   'last_changes': last_changes}
+        columns = {column: value for column, value in columns.items() if value is not None}
+
+        def update(cnx):
+            cur = cnx.cursor()
+            try:
+                cur.execute(f'UPDATE schedules SET {", ".join(f"{column} = {p}" for column in columns)} '
+                            f'WHERE platform = {p} AND query_id = {p}', (*columns.values(), platform, query_id))
+                return cur.rowcount
+            finally:
+                cur.close()
+
+        try:
+            return self.run_in_transaction(update)
+        except (mysql.connector.Error, sqlite3.Error) as e:
+            print('Update Schedule Error:', e)
+            return -1
+
+    def pin_schedules(self, interval: int | None, platform: str = None, query_id: int = None) -> int:
+        """
+        Pin the interval of the schedules of a platform, a query or both, or unpin them with no interval.
+
+        Pinned schedules keep their interval instead of adapting it and run at the next check.
+        """
+        p = '%s' if self.db_type == 'mysql' else '?'
+        conditions, params = ['1 = 1'], []
+        if platform is not None:
+            conditions.append(f'platform = {p}')
+            params.append(platform)
+        if query_id is not None:
+            conditions.append(f'query_id = {p}')
+            params.append(query_id)
+        where = ' AND '.join(conditions)
+
+        def update(cnx):
+            cur = cnx.cursor()
+            try:
+                if interval is None:
+                    cur.execute(f'UPDATE schedules SET pinned = FALSE WHERE {where}', params)
+                else:
+                    cur.execute(f'UPDATE schedules SET pinned = TRUE, interval_minutes = {p}, next_run = NULL '
+                                f'WHERE {where}', (interval, *params))
+                return cur.rowcount
+            finally:
+                cur.close()
+
+        try:
+            return self.run_in_transaction(update)
+        except (mysql.connector.Error, sqlite3.Error) as e:
+            print('Pin Schedules Error:', e)
+            return -1
+
 
 class MySQLDB(DB):
-    def __init__(self, host: str, port: int, user: str, password: str, database: str = 'project-d-db'):
+    def __init__(self, host: str, port: int, user: str, password: str, database: str = 'project-d-db',
+                 history_mode: str = 'full', pool_size: int = MYSQL_POOL_SIZE):
 
         self.host = host
         self.port = port
         self.user = user
         self.password = password
+        self.pool_size = min(pool_size, CNX_POOL_MAXSIZE)
 
         print('MySQL DB')
         print('DB Connection parameters:')
         print('Host:', self.host)
         print('Port:', self.port)
         print('User:', self.user)
+        print('Pool size:', self.pool_size)
+        print('History mode:', history_mode)
         print('')
 
         try:
-            # Connect to server
-            cnx = mysql.connector.connect(
+            # Create a connection pool
+            self.pool = MySQLConnectionPool(
+                pool_name='project-d-pool',
+                pool_size=self.pool_size,
                 host=self.host,
                 port=self.port,
                 user=self.user,
                 password=self.password,
-                database=database)
+                database=database,
+                # Timestamps are written and bucketed in UTC, like on SQLite
+                time_zone='+00:00')
 
-            if not cnx.is_connected():
-                raise mysql.connector.Error('Failed to connect to MySQL server.')
+            # Connections handed out at the same time, callers wait for a free one
+            self.pool_slots = threading.BoundedSemaphore(self.pool_size)
 
-            print('Connected to MySQL server.')
+            super().__init__(None, database, 'mysql', history_mode)
 
-            super().__init__(cnx, database, 'mysql')
+            with self.connection() as cnx:
+                if not cnx.is_connected():
+                    raise mysql.connector.Error('Failed to connect to MySQL server.')
+
+            print('Connected to MySQL server.')
 
         except mysql.connector.Error as e:
             print('DB Init Error:', e)
             exit(0)
 
+    @contextmanager
+    def connection(self):
+        """Check out a pooled connection for the current thread and return it to the pool afterwards."""
+        timer = time.perf_counter()
+        with self.pool_slots:
+            cnx = self.pool.get_connection()
+            metrics.db_wait_seconds.observe(time.perf_counter() - timer, kind='connection')
+            profiling.record('db.wait', timer, time.perf_counter(), kind='connection')
+            try:
+                # Health check, reconnects connections dropped by the server
+                cnx.ping(reconnect=True, attempts=3, delay=1)
+
+                yield cnx
+            finally:
+                # End the read snapshot of a connection that was only used for queries
+                if cnx.in_transaction:
+                    cnx.rollback()
+                cnx.close()
+
+    def db_close(self):
+        if not self.initialized:
+            return
+
+        try:
+            self.pool._remove_connections()
+            print('DB Connections closed')
+        except mysql.connector.Error as e:
+            print('DB Close Error:', e)
+
+
+class SqLiteWriter(threading.Thread):
+    """Owns the only SQLite write connection and runs queued write work one item at a time."""
+
+    def __init__(self, cnx: sqlite3.Connection):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.cnx: sqlite3.Connection = cnx
+        self.queue: queue.Queue[(Callable[[sqlite3.Connection], Any], Future, float, contextvars.Context) | None] = \
+            queue.Queue()
+
+    def submit(self, work: Callable[[sqlite3.Connection], Any]) -> Future:
+        future = Future()
+        # The submitter's context, so the work is recorded into the submitter's run profile
+        self.queue.put((work, future, time.perf_counter(), contextvars.copy_context()))
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def execute(self, work: Callable[[sqlite3.Connection], Any], future: Future, submitted: float):
+        # Time the work waited in the queue for the writer
+        metrics.db_wait_seconds.observe(time.perf_counter() - submitted, kind='writer')
+        profiling.record('db.queue', submitted, time.perf_counter())
+
+        operation = operation_name(work)
+        try:
+            with metrics.db_write_seconds.time(operation=operation), profiling.span('db.write', operation=operation):
+                result = work(self.cnx)
+
+                # Make sure data is committed to the database
+                self.cnx.commit()
+
+            future.set_result(result)
+        except BaseException as e:
+            self.cnx.rollback()
+            future.set_exception(e)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            work, future, submitted, context = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            context.run(self.execute, work, future, submitted)
+
+        self.cnx.close()
+
 
 class SqLiteDB(DB):
-    def __init__(self, db_name: str = 'project-d-db.sqlite', db_dir: str = 'db/'):
+    def __init__(self, db_name: str = 'project-d-db.sqlite', db_dir: str = 'db/', history_mode: str = 'full',
+                 readers: int = SQLITE_READERS):
 
         print('SQLite DB')
         print('DB Connection parameters:')
         print('DB:', db_name)
         print('DB Dir:', db_dir)
+        print('Readers:', readers)
+        print('History mode:', history_mode)
         print('')
 
         try:
             # Connect to server
             os.makedirs(db_dir, exist_ok=True)
-            cnx = sqlite3.connect(os.path.join(db_dir, db_name), check_same_thread=False)
+            self.path = os.path.join(db_dir, db_name)
+            cnx = sqlite3.connect(self.path, check_same_thread=False)
+
+            # Readers do not block the writer and the writer does not block readers in WAL mode
+            cnx.execute('PRAGMA journal_mode = WAL')
+            for pragma in SQLITE_PRAGMAS:
+                cnx.execute(pragma)
+
+            # All writes go through the writer thread
+            self.writer = SqLiteWriter(cnx)
+            self.writer.start()
+
+            # Pool of read-only connections for queries
+            self.readers: queue.Queue[sqlite3.Connection] = queue.Queue()
+            for _ in range(readers):
+                reader = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+                for pragma in SQLITE_PRAGMAS:
+                    reader.execute(pragma)
+                self.readers.put(reader)
 
             print('Connected to SQLite server.')
 
-            super().__init__(cnx, db_name, 'sqlite')
+            super().__init__(cnx, db_name, 'sqlite', history_mode)
 
         except sqlite3.Error as e:
             print('DB Init Error:', e)
             exit(0)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a read-only connection from the pool."""
+        timer = time.perf_counter()
+        cnx = self.readers.get()
+        metrics.db_wait_seconds.observe(time.perf_counter() - timer, kind='connection')
+        profiling.record('db.wait', timer, time.perf_counter(), kind='connection')
+        try:
+            yield cnx
+        finally:
+            self.readers.put(cnx)
+
+    def run_in_transaction(self, work: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run `work(cnx)` on the writer thread and wait for its result."""
+        return self.writer.submit(work).result()
+
+    def checkpoint(self):
+        """Move the WAL content into the main database file, e.g. before copying the file."""
+        self.run_in_transaction(lambda cnx: cnx.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall())
+
+    def db_close(self):
+        if not self.initialized:
+            return
+
+        try:
+            self.writer.stop()
+            while not self.readers.empty():
+                self.readers.get().close()
+            print('DB Connection closed')
+        except sqlite3.Error as e:
+            print('DB Close Error:', e)
+
+
+class AsyncDB:
+    """Awaitable facade over a DB. Blocking DB calls run on a bounded thread pool, not on the event loop."""
+
+    def __init__(self, db: DB, max_workers: int = ASYNC_DB_WORKERS):
+        self.db: DB = db
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async-db')
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run any blocking function on the DB executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return call
+
+    def close(self):
+        self.executor.shutdown(wait=False)
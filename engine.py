@@ -0,0 +1,262 @@
+"""
+Asyncio fetch engine for platform scrapers.
+
+One event loop, running in a background thread, fetches every (platform, query) pair. Platform modules can provide
+`async def search_query_async(query, session)`, which is awaited on the loop with the shared aiohttp session of the
+module `url` host. Modules with only the sync `search_query(query)` are run through an adapter on a worker thread.
+Each platform has its own concurrency limit, so dozens of fetches can be in flight at once.
+
+Modules that also provide `iter_pages_async(query, session)` or `iter_pages(query)` can be consumed page by page with
+`FetchEngine.pages`, so a page can be written to the DB while the next ones are still being fetched. Modules with
+`incremental = True` stop paginating once the pages no longer hold new or changed products (see `crawl`).
+
+Update runs are scheduled as one `Job` per (platform, query) pair by `FetchEngine.run_jobs`. A global pool of
+workers picks the highest priority job (the `priority` of the platform module, 0 by default) whose platform is below
+its concurrency cap, longest jobs (by their previous duration) first. Every job is cancelled at its deadline, so one
+slow query holds up neither its platform nor the run.
+
+Blocking calls of sync drivers run on fetch threads of their own, one per worker, so network waits and rate limiter
+sleeps never hold up DB work. DB work started with `asyncio.to_thread` runs on the loop's default executor, sized by
+`DB_WORKERS`.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from types import ModuleType
+from typing import Coroutine, Any, AsyncIterator, Callable
+
+import crawl
+import http_sessions
+import metrics
+import profiling
+import ratelimit
+
+PLATFORM_CONCURRENCY = 4
+# Jobs running at the same time across all platforms
+WORKERS: int = int(os.getenv('FETCH_WORKERS', 16))
+# Seconds a (platform, query) job may run before it is cancelled
+JOB_DEADLINE: float = float(os.getenv('FETCH_JOB_DEADLINE', 60 * 10))
+# Threads of the loop's default executor, running the DB work of the jobs
+DB_WORKERS: int = int(os.getenv('FETCH_DB_WORKERS', 4))
+
+
+class Job:
+    """A (platform, query) update, `run` creates the coroutine doing the work."""
+
+    def __init__(self, platform: str, module: ModuleType, query: str, run: Callable[[], Coroutine],
+                 priority: int = None, deadline: float = None):
+        self.platform: str = platform
+        self.module: ModuleType = module
+        self.query: str = query
+        self.run: Callable[[], Coroutine] = run
+        # Modules may set their own `priority` and `deadline`
+        self.priority: int = priority if priority is not None else getattr(module, 'priority', 0)  # Higher runs first
+        self.deadline: float = deadline or getattr(module, 'deadline', JOB_DEADLINE)
+
+
+class FetchEngine:
+    def __init__(self, platform_concurrency: int = PLATFORM_CONCURRENCY, workers: int = WORKERS,
+                 db_workers: int = DB_WORKERS):
+        self.platform_concurrency: int = platform_concurrency
+        self.workers: int = workers
+        self.db_workers: int = db_workers
+        # Last duration of every (platform, query) job, used to start the longest jobs first
+        self.durations: dict[(str, str), float] = {}
+
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.fetch_executor: ThreadPoolExecutor | None = None
+        self.limits: dict[str, asyncio.Semaphore] = {}
+
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop:
+                return
+
+            self.loop = asyncio.new_event_loop()
+            self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.db_workers,
+                                                              thread_name_prefix='fetch-db'))
+            self.fetch_executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fetch')
+            self.thread = threading.Thread(target=self.loop.run_forever, name='fetch-engine', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            if not self.loop:
+                return
+
+            asyncio.run_coroutine_threadsafe(http_sessions.close_async_sessions(), self.loop).result()
+
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+
+            self.fetch_executor.shutdown(wait=False)
+            self.fetch_executor = None
+
+    def run(self, coro: Coroutine) -> Any:
+        """Run a coroutine on the engine loop from any other thread and wait for its result."""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def run_sync(self, func: Callable, *args) -> Any:
+        """Run a blocking driver call on a fetch thread, in a copy of the current context like `asyncio.to_thread`."""
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.fetch_executor,
+                                                                functools.partial(context.run, func, *args))
+
+    def platform_cap(self, module: ModuleType) -> int:
+        return getattr(module, 'concurrency', self.platform_concurrency)
+
+    def expected_duration(self, job: Job) -> float:
+        # Jobs that never ran are expected to be long
+        return self.durations.get((job.platform, job.query), float('inf'))
+
+    async def run_job(self, job: Job) -> bool:
+        """Run a job until its deadline, returns False if it was cancelled at the deadline."""
+        timer = time.time()
+        try:
+            # Every job is drawn on its own lane of the run timeline
+            with profiling.span('job', new_lane=True, platform=job.platform, query=job.query):
+                await asyncio.wait_for(job.run(), job.deadline)
+            return True
+        except asyncio.TimeoutError:
+            print('Job', job.platform, 'query', job.query, 'cancelled at its deadline of', job.deadline, 's')
+            metrics.job_deadlines.inc(platform=job.platform)
+            return False
+        except Exception as e:
+            print('Job', job.platform, 'query', job.query, 'error:', e)
+            return True
+        finally:
+            self.durations[(job.platform, job.query)] = time.time() - timer
+
+    async def run_jobs(self, jobs: [Job]) -> dict:
+        """
+        Run jobs on the global worker pool, returns run statistics.
+
+        Jobs are started by priority, then by their previous duration (longest first), skipping jobs whose platform
+        is at its concurrency cap until one of its jobs finishes.
+        """
+        pending = sorted(jobs, key=lambda job: (job.priority, self.expected_duration(job)), reverse=True)
+        running: dict[asyncio.Task, Job] = {}
+        platform_running: dict[str, int] = {}
+        stats = {'jobs': len(jobs), 'timeouts': 0, 'seconds': 0.0, 'work_seconds': 0.0, 'platforms': {}}
+        # First job start and last job end of every platform
+        platform_times: dict[str, list[float]] = {}
+        # Fetch counters at the start of the run
+        counters = {job.platform: (metrics.pages_fetched.get(platform=job.platform),
+                                   metrics.products_fetched.get(platform=job.platform)) for job in jobs}
+
+        timer = time.time()
+
+        while pending or running:
+            # Start the next jobs the pool and the platform caps allow
+            for job in list(pending):
+                if len(running) >= self.workers:
+                    break
+                if platform_running.get(job.platform, 0) >= self.platform_cap(job.module):
+                    continue
+
+                pending.remove(job)
+                platform_running[job.platform] = platform_running.get(job.platform, 0) + 1
+                platform_times.setdefault(job.platform, [time.time(), time.time()])
+                running[asyncio.create_task(self.run_job(job))] = job
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                job = running.pop(task)
+                platform_running[job.platform] -= 1
+                platform_times[job.platform][1] = time.time()
+
+                if not task.result():
+                    stats['timeouts'] += 1
+                stats['work_seconds'] += self.durations[(job.platform, job.query)]
+
+        stats['seconds'] = round(time.time() - timer, 2)
+        stats['work_seconds'] = round(stats['work_seconds'], 2)
+        for platform, (start, end) in platform_times.items():
+            stats['platforms'][platform] = {
+                'seconds': round(end - start, 2),
+                'jobs': sum(job.platform == platform for job in jobs),
+                'pages': metrics.pages_fetched.get(platform=platform) - counters[platform][0],
+                'products': metrics.products_fetched.get(platform=platform) - counters[platform][1],
+            }
+            metrics.run_pages.set(stats['platforms'][platform]['pages'], platform=platform)
+            metrics.run_products.set(stats['platforms'][platform]['products'], platform=platform)
+        return stats
+
+    def platform_limit(self, platform: str, module: ModuleType) -> asyncio.Semaphore:
+        """Semaphore limiting concurrent fetches of a platform, modules may set their own `concurrency`."""
+        if platform not in self.limits:
+            # Name the request rate limiter of the platform host
+            ratelimit.register(platform, http_sessions.host_of(getattr(module, 'url', '')),
+                               getattr(module, 'rate_limit', None))
+            self.limits[platform] = asyncio.Semaphore(self.platform_cap(module))
+        return self.limits[platform]
+
+    async def pages(self, platform: str, module: ModuleType, query: str) -> AsyncIterator[list[dict]]:
+        """Yield the products of a query page by page, stopping early on unchanged pages of incremental platforms."""
+        async with aclosing(self.fetch_pages(platform, module, query)) as pages:
+            incremental = getattr(module, 'incremental', False)
+            if incremental:
+                state = crawl.get_crawl(platform, query)
+                full = state.start_run(getattr(module, 'full_crawl_every', crawl.full_crawl_every))
+                limit = getattr(module, 'unchanged_pages', crawl.unchanged_pages)
+
+            count = 0
+            unchanged = 0
+            timer = time.perf_counter()
+            async for page in pages:
+                metrics.fetch_page_seconds.observe(time.perf_counter() - timer, platform=platform)
+                profiling.record('page', timer, time.perf_counter(), platform=platform, products=len(page))
+                metrics.pages_fetched.inc(platform=platform)
+                metrics.products_fetched.inc(len(page), platform=platform)
+
+                count += 1
+                yield page
+
+                if incremental:
+                    unchanged = unchanged + 1 if state.update(page) == 0 else 0
+                    if not full and unchanged >= limit:
+                        print('Incremental crawl of', platform, 'query', query, 'stopped after', count, 'pages')
+                        return
+
+                timer = time.perf_counter()
+
+    async def fetch_pages(self, platform: str, module: ModuleType, query: str) -> AsyncIterator[list[dict]]:
+        """Yield the products of a query page by page, holding the platform limit until the last page."""
+        async with self.platform_limit(platform, module):
+            if hasattr(module, 'iter_pages_async'):
+                session = http_sessions.get_async_session(getattr(module, 'url', ''))
+                async for page in module.iter_pages_async(query, session):
+                    yield page
+
+            elif hasattr(module, 'iter_pages'):
+                # Adapter for sync page generators, each page is pulled on a fetch thread
+                pages = module.iter_pages(query)
+                try:
+                    while (page := await self.run_sync(next, pages, None)) is not None:
+                        yield page
+                finally:
+                    try:
+                        pages.close()
+                    except ValueError:
+                        # Still running on its worker thread after a cancellation
+                        pass
+
+            else:
+                # Modules without pages deliver the whole result as a single page
+                if hasattr(module, 'search_query_async'):
+                    session = http_sessions.get_async_session(getattr(module, 'url', ''))
+                    data = await module.search_query_async(query, session)
+                else:
+                    data = await self.run_sync(module.search_query, query)
+                yield data['products']
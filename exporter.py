@@ -139,8 +139,9 @@ def export_to_xlsx(db: DB, query: str = None, file_name: str = 'export.xlsx',
             prices_worksheet.set_column(1, 100, 30)  # price and created_at columns
 
             row = 0
+            prices_history = db.get_prices_batch([good[0] for good in goods[:1000]])
             for good in goods[:1000]:
-                prices = db.get_prices(good[0])
+                prices = prices_history.get(good[0])
                 if prices:
                     print(f'Price. Good ID: {good[0]}')
                     prices_worksheet.merge_range(row, 0, row, 5, f'Good ID: {good[0]}', center_align_format)
@@ -180,8 +181,9 @@ def export_to_xlsx(db: DB, query: str = None, file_name: str = 'export.xlsx',
             in_stock_worksheet.set_column(1, 100, 30)  # in_stock and created_at columns
 
             row = 0
+            in_stock_history = db.get_in_stock_batch([good[0] for good in goods[:1000]])
             for good in goods[:1000]:
-                in_stock = db.get_in_stock(good[0])
+                in_stock = in_stock_history.get(good[0])
                 if in_stock:
                     print(f'In Stock. Good ID: {good[0]}')
                     in_stock_worksheet.merge_range(row, 0, row, 5, f'Good ID: {good[0]}', center_align_format)
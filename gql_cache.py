@@ -0,0 +1,62 @@
+"""
+Process-wide cache of parsed GraphQL documents and clients for the GraphQL platforms.
+
+Documents are read and parsed once per file. Clients are built once per endpoint, with the schema loaded from an
+on-disk snapshot when one exists, otherwise introspected once. Queries keep being validated against the schema.
+"""
+import os
+import threading
+
+from gql import Client, gql
+from graphql import DocumentNode, print_schema
+
+import http_sessions
+
+documents: dict[str, DocumentNode] = {}
+clients: dict[str, Client] = {}
+lock = threading.Lock()
+
+
+def get_document(path: str) -> DocumentNode:
+    with lock:
+        if path not in documents:
+            with open(path, 'r') as file:
+                query_str = file.read()
+
+            if not query_str:
+                raise Exception('Failed to read the query file')
+
+            documents[path] = gql(query_str)
+
+        return documents[path]
+
+
+def get_client(url: str, schema_path: str = None, save_schema: bool = False) -> Client:
+    """
+    Return the shared client of a GraphQL endpoint.
+
+    The schema is read from `schema_path` if the snapshot exists, otherwise fetched from the endpoint and, with
+    `save_schema`, written to `schema_path` for the next start.
+    """
+    with lock:
+        if url not in clients:
+            # Retries and keep-alive come from the shared session of the host
+            transport = http_sessions.SharedSessionTransport(url=url, verify=True)
+
+            if schema_path and os.path.exists(schema_path):
+                with open(schema_path, 'r') as file:
+                    client = Client(transport=transport, schema=file.read())
+            else:
+                client = Client(transport=transport, fetch_schema_from_transport=True)
+
+                # Introspect the schema now, once
+                with client:
+                    pass
+
+                if schema_path and save_schema:
+                    with open(schema_path, 'w') as file:
+                        file.write(print_schema(client.schema))
+
+            clients[url] = client
+
+        return clients[url]
@@ -0,0 +1,137 @@
+"""
+Process-wide registry of keep-alive HTTP sessions, one per host.
+
+Platform drivers draw their sessions from here instead of opening a new connection for every page. Sessions are
+reused across scheduled runs. Sync sessions (requests) retry connection errors in the transport adapter; async
+sessions (aiohttp) live on the fetch engine loop. Every request waits for the rate limiter of its host, and throttled
+responses (429, 5xx) are retried once the limiter backoff is over.
+"""
+import asyncio
+import os
+import threading
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
+from gql.transport.requests import RequestsHTTPTransport
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
+
+import ratelimit
+
+pool_size: int = int(os.getenv('HTTP_POOL_SIZE', 16))
+retries: int = int(os.getenv('HTTP_RETRIES', 3))
+backoff_factor: float = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+
+try:
+    import brotli  # noqa: F401 (decodes 'br' responses in urllib3 and aiohttp)
+
+    accept_encoding = 'gzip, deflate, br'
+except ImportError:
+    accept_encoding = 'gzip, deflate'
+
+
+class RateLimitedSession(requests.Session):
+    """requests session that paces every request with the rate limiter of its host."""
+
+    def __init__(self, limiter: ratelimit.RateLimiter):
+        super().__init__()
+        self.limiter: ratelimit.RateLimiter = limiter
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        for attempt in range(retries + 1):
+            self.limiter.acquire()
+            response = super().request(method, url, *args, **kwargs)
+
+            if not self.limiter.on_response(response.status_code, response.headers.get('Retry-After')) \
+                    or attempt == retries:
+                return response
+
+            response.close()
+
+
+sessions: dict[str, requests.Session] = {}
+async_sessions: dict[str, aiohttp.ClientSession] = {}
+lock = threading.Lock()
+
+
+def host_of(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def get_session(url: str) -> requests.Session:
+    """Return the shared requests session for the host of `url`."""
+    host = host_of(url)
+
+    with lock:
+        if host not in sessions:
+            session = RateLimitedSession(ratelimit.get_limiter(host))
+            session.headers['Accept-Encoding'] = accept_encoding
+
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                  max_retries=Retry(total=retries, backoff_factor=backoff_factor, allowed_methods=None,
+                                                    respect_retry_after_header=False))
+            for prefix in 'http://', 'https://':
+                session.mount(prefix, adapter)
+
+            sessions[host] = session
+
+        return sessions[host]
+
+
+def get_async_session(url: str) -> aiohttp.ClientSession:
+    """Return the shared aiohttp session for the host of `url`. Must be called on the fetch engine loop."""
+    host = host_of(url)
+
+    session = async_sessions.get(host)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=pool_size, keepalive_timeout=60)
+        session = aiohttp.ClientSession(connector=connector, headers={'Accept-Encoding': accept_encoding})
+        async_sessions[host] = session
+
+    return session
+
+
+async def request_async(session: aiohttp.ClientSession, method: str, url: str, **kwargs) -> (int, bytes):
+    """Send a request paced by the rate limiter of the host, with retries, returns the status and the body."""
+    limiter = ratelimit.get_limiter(host_of(url))
+
+    for attempt in range(retries + 1):
+        await limiter.acquire_async()
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                body = await response.read()
+
+                if not limiter.on_response(response.status, response.headers.get('Retry-After')) or attempt == retries:
+                    return response.status, body
+
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+
+            limiter.on_throttle()
+
+
+async def close_async_sessions():
+    for session in async_sessions.values():
+        await session.close()
+    async_sessions.clear()
+
+
+def close_sessions():
+    with lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+class SharedSessionTransport(RequestsHTTPTransport):
+    """gql requests transport that uses the shared session of its host instead of a new session per connect."""
+
+    def connect(self):
+        if self.session is None:
+            self.session = get_session(self.url)
+
+    def close(self):
+        # Keep the shared session open for the next query and for clients sharing this transport
+        pass
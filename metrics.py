@@ -0,0 +1,146 @@
+"""
+Process-wide metrics in the Prometheus text exposition format, served by `/metrics`.
+
+Counters, gauges and histograms are registered once at import time by the modules they measure and updated from any
+thread. Label values are passed as keyword arguments, e.g. `fetch_page_seconds.observe(0.4, platform='olx')`.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type: str = ''
+
+    def __init__(self, name: str, description: str):
+        self.name: str = name
+        self.description: str = description
+        self.values: dict[tuple, Any] = {}
+        self.lock = threading.Lock()
+
+        registry.append(self)
+
+    @staticmethod
+    def key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def samples(self) -> [str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def samples(self) -> [str]:
+        return [f'{self.name}{format_labels(key)} {format_value(value)}' for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets: tuple = tuple(buckets) + (float('inf'),)
+        super().__init__(name, description)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                # Bucket counts, sum and count
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = self.values[key]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        timer = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - timer, **labels)
+
+    def samples(self) -> [str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(f'{self.name}_bucket{format_labels(key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(key)} {count}')
+        return lines
+
+
+registry: [Metric] = []
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+# Fetching
+fetch_page_seconds = Histogram('project_d_fetch_page_seconds', 'Time to fetch and parse one page of a query')
+pages_fetched = Counter('project_d_pages_fetched_total', 'Pages fetched')
+products_fetched = Counter('project_d_products_fetched_total', 'Products fetched')
+run_pages = Gauge('project_d_run_pages', 'Pages fetched by the last update run')
+run_products = Gauge('project_d_run_products', 'Products fetched by the last update run')
+job_deadlines = Counter('project_d_job_deadline_exceeded_total', 'Jobs cancelled at their deadline')
+
+# Update runs
+update_run_seconds = Histogram('project_d_update_run_seconds', 'Duration of update runs')
+query_overruns = Counter('project_d_query_overruns_total', 'Query refreshes that took longer than their interval')
+
+# DB
+db_write_seconds = Histogram('project_d_db_write_seconds', 'Duration of DB write transactions')
+db_wait_seconds = Histogram('project_d_db_wait_seconds', 'Time spent waiting for a DB connection or the writer')
+db_rows_inserted = Counter('project_d_db_rows_inserted_total', 'Rows inserted by ingests')
+
+# API
+api_request_seconds = Histogram('project_d_api_request_seconds', 'API request latency')
@@ -0,0 +1,144 @@
+"""
+Versioned schema migrations.
+
+`db_init` creates the base tables, then `migrate` applies every migration newer than the version stored in the
+`schema_version` table, in order. A migration is a function of a cursor and the DB type, it must be safe to re-run.
+"""
+import time
+
+
+def create_index(cur, db_type: str, name: str, table: str, columns: str, unique: bool = False):
+    if db_type == 'sqlite':
+        cur.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+    elif db_type == 'mysql':
+        # MySQL has no CREATE INDEX IF NOT EXISTS
+        cur.execute('''
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        ''', (table, name))
+        if not cur.fetchone()[0]:
+            cur.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX {name} ON {table} ({columns})')
+
+    print('Index', name, 'created')
+
+
+def goods_identity(cur, db_type: str):
+    # Merge duplicated goods into the oldest one before adding the unique index
+    duplicates = '''
+        SELECT g.id FROM goods g
+        JOIN goods d ON d.platform = g.platform AND d.platform_id = g.platform_id AND d.query_id = g.query_id
+        AND d.id < g.id
+    '''
+    oldest = '''
+        SELECT MIN(d.id) FROM goods g
+        JOIN goods d ON d.platform = g.platform AND d.platform_id = g.platform_id AND d.query_id = g.query_id
+        WHERE g.id = {table}.good_id
+    '''
+
+    # A good with several older copies appears once per copy
+    cur.execute(f'SELECT COUNT(DISTINCT id) FROM ({duplicates}) duplicates')
+    count = cur.fetchone()[0]
+    if count:
+        print('Merging', count, 'duplicated goods')
+        for table in ('prices', 'in_stock'):
+            cur.execute(f'''
+                UPDATE {table} SET good_id = ({oldest.format(table=table)})
+                WHERE good_id IN (SELECT id FROM ({duplicates}) duplicates)
+            ''')
+        cur.execute(f'DELETE FROM goods WHERE id IN (SELECT id FROM ({duplicates}) duplicates)')
+
+    create_index(cur, db_type, 'goods_identity_uindex', 'goods', 'platform, platform_id, query_id', unique=True)
+
+
+def history_indexes(cur, db_type: str):
+    # Covering indexes for per-good history queries ordered by time
+    create_index(cur, db_type, 'prices_good_id_timestamp_index', 'prices', 'good_id, timestamp, price')
+    create_index(cur, db_type, 'in_stock_good_id_timestamp_index', 'in_stock', 'good_id, timestamp, in_stock')
+
+    create_index(cur, db_type, 'goods_platform_id_query_id_index', 'goods', 'platform_id, query_id')
+    create_index(cur, db_type, 'goods_query_id_index', 'goods', 'query_id')
+
+
+def goods_listing_indexes(cur, db_type: str):
+    # Filters of the paginated goods listing
+    create_index(cur, db_type, 'goods_brand_index', 'goods', 'brand')
+    create_index(cur, db_type, 'goods_last_updated_index', 'goods', 'last_updated')
+
+
+def refresh_schedules(cur, db_type: str):
+    # Refresh schedule of every (platform, query) pair, see `refresh`
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schedules (
+            platform VARCHAR(255) NOT NULL,
+            query_id INT NOT NULL,
+            interval_minutes INT NOT NULL,
+            pinned BOOLEAN DEFAULT FALSE,
+            next_run TIMESTAMP NULL,
+            last_run TIMESTAMP NULL,
+            last_changes INT DEFAULT 0,
+            PRIMARY KEY (platform, query_id)
+        );
+    ''')
+    print('Table schedules created')
+
+    create_index(cur, db_type, 'schedules_next_run_index', 'schedules', 'next_run')
+
+
+# (version, description, migration) in the order they are applied
+MIGRATIONS = [
+    (1, 'Unique goods identity', goods_identity),
+    (2, 'History and goods lookup indexes', history_indexes),
+    (3, 'Goods listing indexes', goods_listing_indexes),
+    (4, 'Refresh schedules', refresh_schedules),
+]
+
+
+def schema_version(db) -> int:
+    with db.connection() as cnx:
+        cur = cnx.cursor()
+        cur.execute('SELECT MAX(version) FROM schema_version')
+        version = cur.fetchone()[0]
+        cur.close()
+        return version or 0
+
+
+def migrate(db) -> int:
+    """Apply pending migrations and return the resulting schema version."""
+
+    def create_schema_version(cnx):
+        cur = cnx.cursor()
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT NOT NULL PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        ''')
+        cur.close()
+
+    db.run_in_transaction(create_schema_version)
+
+    version = schema_version(db)
+    print('Schema version:', version)
+
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        print(f'Applying migration {migration_version}: {description}...')
+        timer = time.time()
+
+        def apply(cnx):
+            cur = cnx.cursor()
+            migration(cur, db.db_type)
+
+            p = '%s' if db.db_type == 'mysql' else '?'
+            cur.execute(f'INSERT INTO schema_version (version, description) VALUES ({p}, {p})',
+                        (migration_version, description))
+            cur.close()
+
+        db.run_in_transaction(apply)
+        version = migration_version
+        print(f'Migration {migration_version} applied in {round(time.time() - timer, 2)} s')
+
+    return version
@@ -1,15 +1,20 @@
-import json
 import logging
 import os
 import time
 
-from gql.transport.requests import RequestsHTTPTransport
-
-from gql import Client, gql
+import codec
+import gql_cache
 
 platform_name = 'bigl'
 url = 'https://bigl.ua/graphql'
+# Starting requests per second, tuned by the rate limiter afterwards
+rate_limit = 1
+# Stop paginating once pages hold no new or changed products, with a full crawl every few runs
+incremental = True
 gql_query_filepath = 'platforms/gql/bigl/bigl-gql-query.gql'
+# Schema snapshot used instead of introspection when present
+gql_schema_filepath = 'platforms/gql/bigl/bigl-gql-schema.graphql'
+save_schema = False
 
 limit = 95
 max_products = 5000
@@ -23,30 +28,19 @@ log_dir = f'platforms/fetched/{platform_name}/'
 logger = logging.getLogger(__name__)
 
 
-def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries: bool = False) -> dict:
+def iter_pages(query: str, timeout: int = 60 * 5, log_queries: bool = False):
+    """Yield the products of each fetched page."""
     logger.info('[BIGL] Fetching data from Bigl')
     logger.debug('[BIGL] Query: ' + query)
 
-    params['search_term'] = query
+    query_params = dict(params, search_term=query)
 
-    result_data = {'products': [], 'timestamp': time.time()}
+    count = 0
     offset = 0
 
-    transport = RequestsHTTPTransport(
-        url=url,
-        verify=True,
-        retries=3,
-    )
-
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-
-    with open(gql_query_filepath, 'r') as file:
-        query_str = file.read()
-
-    if not query_str:
-        raise Exception('Failed to read the query file')
-
-    gql_query = gql(query_str)
+    # Parsed query and client are cached for the whole process
+    client = gql_cache.get_client(url, gql_schema_filepath, save_schema)
+    gql_query = gql_cache.get_document(gql_query_filepath)
 
     timer = time.time()
 
@@ -57,16 +51,15 @@ def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries:
             raise Exception('Timeout reached')
 
         logger.debug('[BIGL] offset: ' + str(offset))
-        params['offset'] = offset
+        query_params['offset'] = offset
 
-        data = client.execute(gql_query, variable_values=params)
+        data = client.execute(gql_query, variable_values=query_params)
         # print(data)
 
         # Save the response to a file
         if log_dir and log_queries:
             os.makedirs(log_dir, exist_ok=True)
-            with open(os.path.join(log_dir, f'{query}-{offset}-{time.time()}.json'), 'w') as f:
-                json.dump(data, f, indent=2)
+            codec.dump(data, os.path.join(log_dir, f'{query}-{offset}-{time.time()}.json'))
 
         products = data['searchListing']['page']['products']
 
@@ -75,14 +68,16 @@ def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries:
 
         logger.debug('[BIGL] fetched: ' + str(len(products)))
 
+        page = []
         for _ in products:
             product = _['product']
 
-            if max_products and len(result_data['products']) >= max_products:
+            if max_products and count >= max_products:
                 logger.warning('[BIGL] Max products reached')
-                return result_data
+                yield page
+                return
 
-            result_data['products'].append({
+            page.append({
                 'id': product['id'],
                 'name': product['name'],
                 'href': product['url'],
@@ -91,12 +86,22 @@ def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries:
                 'price': product['price'],
                 'in_stock': product['presence'] and product['presence'] == 'avail'
             })
+            count += 1
+
+        yield page
 
         logger.debug('[BIGL] done')
         offset += limit
-        time.sleep(delay)
 
     logger.info('[BIGL] Fetching data from ' + platform_name + ' done')
+
+
+def search_query(query: str, timeout: int = 60 * 5, log_queries: bool = False) -> dict:
+    result_data = {'products': [], 'timestamp': time.time()}
+
+    for page in iter_pages(query, timeout, log_queries):
+        result_data['products'].extend(page)
+
     return result_data
 
 # print(search_query('Чохол для iPhone 12 Pro Max'))
@@ -1,12 +1,18 @@
-import json
 import logging
 import os
 import time
 
-import requests
+import aiohttp
+
+import codec
+import http_sessions
 
 platform_name = 'olx'
 url = 'https://www.olx.ua/api/v1/offers/'
+# Starting requests per second, tuned by the rate limiter afterwards
+rate_limit = 1
+# Stop paginating once pages hold no new or changed products, with a full crawl every few runs
+incremental = True
 
 limit = 50
 max_products: int | None = None
@@ -20,13 +26,57 @@ log_dir = f'platforms/fetched/{platform_name}/'
 logger = logging.getLogger(platform_name)
 
 
-def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries: bool = False) -> dict:
+def parse_product(product: dict) -> dict:
+    product_params = product['params']
+    price = None
+    try:
+        # logger.debug('[OLX] params:', product_params)
+        price_param_index = next(
+            (i for i, item in enumerate(product_params) if
+             item.get('key') == 'price' and item.get('type') == 'price'), None)
+        if price_param_index is not None:
+            price = product_params[price_param_index]['value']['value']
+        # logger.debug('[OLX] price:', price)
+    except Exception as e:
+        logger.warning('[OLX] Price extraction error: ' + str(e))
+
+    return {
+        'id': product['id'],
+        'name': product['title'],
+        'href': product['url'],
+        'img_href': product['photos'][0]['link'] if product['photos'] else None,
+        'brand': None,
+        'price': price,
+        'in_stock': True,
+    }
+
+
+def save_response(query: str, offset: int, data: dict):
+    os.makedirs(log_dir, exist_ok=True)
+    codec.dump(data, os.path.join(log_dir, f'{query}-{offset}-{time.time()}.json'))
+
+
+def parse_page(products: [dict], count: int) -> ([dict], bool):
+    """Parse the products of a page, returns them and False once max_products is reached."""
+    page = []
+    for product in products:
+        if max_products and count + len(page) >= max_products:
+            logger.warning('[OLX] Max products reached')
+            return page, False
+
+        page.append(parse_product(product))
+
+    return page, True
+
+
+def iter_pages(query: str, timeout: int = 60 * 5, log_queries: bool = False):
+    """Yield the products of each fetched page."""
     logger.info('[OLX] Fetching data from OLX')
     logger.debug('[OLX] Query: ' + query)
 
-    params['query'] = query
+    query_params = dict(params, query=query)
 
-    result_data = {'products': [], 'timestamp': time.time()}
+    count = 0
     offset = 0
 
     timer = time.time()
@@ -38,24 +88,22 @@ def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries:
             raise Exception('Timeout reached')
 
         logger.debug('[OLX] offset: ' + str(offset))
-        params['offset'] = offset
+        query_params['offset'] = offset
 
-        response = requests.get(url, params=params)
+        response = http_sessions.get_session(url).get(url, params=query_params)
         if response.status_code != 200:
-            if response.json()['error']['title'] == 'Invalid request':
+            if codec.loads(response.content)['error']['title'] == 'Invalid request':
                 logger.warning('[OLX] Invalid request. Maybe reached the end?')
-                return result_data
+                return
 
             raise Exception('Failed to fetch data:', response.status_code, response.text)
 
         # Parse the JSON response
-        data = response.json()
+        data = codec.loads(response.content)
 
         # Save the response to a file
         if log_dir and log_queries:
-            os.makedirs(log_dir, exist_ok=True)
-            with open(os.path.join(log_dir, f'{query}-{offset}-{time.time()}.json'), 'w') as f:
-                json.dump(data, f, indent=2)
+            save_response(query, offset, data)
 
         products = data['data']
 
@@ -64,39 +112,93 @@ def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries:
 
         logger.debug('[OLX] fetched:' + str(len(products)))
 
-        for product in products:
-            if max_products and len(result_data['products']) >= max_products:
-                logger.warning('[OLX] Max products reached')
-                return result_data
-
-            product_params = product['params']
-            price = None
-            try:
-                # logger.debug('[OLX] params:', product_params)
-                price_param_index = next(
-                    (i for i, item in enumerate(product_params) if
-                     item.get('key') == 'price' and item.get('type') == 'price'), None)
-                if price_param_index is not None:
-                    price = product_params[price_param_index]['value']['value']
-                # logger.debug('[OLX] price:', price)
-            except Exception as e:
-                logger.warning('[OLX] Price extraction error: ' + str(e))
-
-            result_data['products'].append({
-                'id': product['id'],
-                'name': product['title'],
-                'href': product['url'],
-                'img_href': product['photos'][0]['link'] if product['photos'] else None,
-                'brand': None,
-                'price': price,
-                'in_stock': True,
-            })
+        page, more = parse_page(products, count)
+        count += len(page)
+        yield page
+
+        if not more:
+            return
 
         logger.debug('[OLX] done')
         offset += limit
-        time.sleep(delay)
 
     logger.info('[OLX] Fetching data from ' + platform_name + ' done')
+
+
+async def iter_pages_async(query: str, session: aiohttp.ClientSession, timeout: int = 60 * 5,
+                           log_queries: bool = False):
+    """Yield the products of each fetched page."""
+    logger.info('[OLX] Fetching data from OLX')
+    logger.debug('[OLX] Query: ' + query)
+
+    query_params = dict(params, query=query)
+
+    count = 0
+    offset = 0
+
+    timer = time.time()
+
+    while True:
+
+        if time.time() - timer >= timeout:
+            logger.warning('[OLX] Timeout reached')
+            raise Exception('Timeout reached')
+
+        logger.debug('[OLX] offset: ' + str(offset))
+        query_params['offset'] = offset
+
+        status, body = await http_sessions.request_async(session, 'GET', url, params=query_params)
+
+        # Parse the JSON response
+        data = codec.loads(body)
+
+        if status != 200:
+            if data['error']['title'] == 'Invalid request':
+                logger.warning('[OLX] Invalid request. Maybe reached the end?')
+                return
+
+            raise Exception('Failed to fetch data:', status, data)
+
+        # Save the response to a file
+        if log_dir and log_queries:
+            save_response(query, offset, data)
+
+        products = data['data']
+
+        if not products:
+            break
+
+        logger.debug('[OLX] fetched:' + str(len(products)))
+
+        page, more = parse_page(products, count)
+        count += len(page)
+        yield page
+
+        if not more:
+            return
+
+        logger.debug('[OLX] done')
+        offset += limit
+
+    logger.info('[OLX] Fetching data from ' + platform_name + ' done')
+
+
+def search_query(query: str, timeout: int = 60 * 5, log_queries: bool = False) -> dict:
+    result_data = {'products': [], 'timestamp': time.time()}
+
+    for page in iter_pages(query, timeout, log_queries):
+        result_data['products'].extend(page)
+
+    return result_data
+
+
+async def search_query_async(query: str, session: aiohttp.ClientSession, timeout: int = 60 * 5,
+                             log_queries: bool = False) -> dict:
+    result_data = {'products': [], 'timestamp': time.time()}
+
+    async for page in iter_pages_async(query, session, timeout, log_queries):
+        result_data['products'].extend(page)
+
     return result_data
 
 # print(search_query('Чехол Iphone 15'))
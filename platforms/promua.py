@@ -1,14 +1,20 @@
-import json
 import logging
 import os
 import time
 
-from gql.transport.requests import RequestsHTTPTransport
-from gql import Client, gql
+import codec
+import gql_cache
 
 platform_name = 'promua'
 url = 'https://prom.ua/graphql'
+# Starting requests per second, tuned by the rate limiter afterwards
+rate_limit = 1
+# Stop paginating once pages hold no new or changed products, with a full crawl every few runs
+incremental = True
 gql_query_filepath = 'platforms/gql/promua/promua-gql-query.gql'
+# Schema snapshot used instead of introspection when present
+gql_schema_filepath = 'platforms/gql/promua/promua-gql-schema.graphql'
+save_schema = False
 
 limit = 95
 max_products: int | None = None
@@ -22,30 +28,19 @@ log_dir = f'platforms/fetched/{platform_name}/'
 logger = logging.getLogger(platform_name)
 
 
-def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries: bool = False) -> dict:
+def iter_pages(query: str, timeout: int = 60 * 5, log_queries: bool = False):
+    """Yield the products of each fetched page."""
     logger.info('[PROM.UA] Fetching data from PromUA')
     logger.debug('[PROM.UA] Query: ' + query)
 
-    params['search_term'] = query
+    query_params = dict(params, search_term=query)
 
-    result_data = {'products': [], 'timestamp': time.time()}
+    count = 0
     offset = 0
 
-    transport = RequestsHTTPTransport(
-        url=url,
-        verify=True,
-        retries=3,
-    )
-
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-
-    with open(gql_query_filepath, 'r') as file:
-        query_str = file.read()
-
-    if not query_str:
-        raise Exception('Failed to read the query file')
-
-    gql_query = gql(query_str)
+    # Parsed query and client are cached for the whole process
+    client = gql_cache.get_client(url, gql_schema_filepath, save_schema)
+    gql_query = gql_cache.get_document(gql_query_filepath)
 
     timer = time.time()
 
@@ -56,16 +51,15 @@ def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries:
             raise Exception('Timeout reached')
 
         logger.debug('[PROM.UA] offset: ' + str(offset))
-        params['offset'] = offset
+        query_params['offset'] = offset
 
-        data = client.execute(gql_query, variable_values=params)
+        data = client.execute(gql_query, variable_values=query_params)
         # print(data)
 
         # Save the response to a file
         if log_dir and log_queries:
             os.makedirs(log_dir, exist_ok=True)
-            with open(os.path.join(log_dir, f'{query}-{offset}-{time.time()}.json'), 'w') as f:
-                json.dump(data, f, indent=2)
+            codec.dump(data, os.path.join(log_dir, f'{query}-{offset}-{time.time()}.json'))
 
         products = data['searchListing']['page']['products']
 
@@ -74,14 +68,16 @@ def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries:
 
         logger.debug('[PROM.UA] fetched: ' + str(len(products)))
 
+        page = []
         for _ in products:
             product = _['product']
 
-            if max_products and len(result_data['products']) >= max_products:
+            if max_products and count >= max_products:
                 logger.warning('[PROM.UA] Max products reached')
-                return result_data
+                yield page
+                return
 
-            result_data['products'].append({
+            page.append({
                 'id': product['id'],
                 'name': product['name'],
                 'href': product['urlForProductViewOnSite'],
@@ -90,12 +86,22 @@ def search_query(query: str, timeout: int = 60 * 5, delay: int = 1, log_queries:
                 'price': product['price'],
                 'in_stock': product['presence'] and product['presence']['isAvailable']
             })
+            count += 1
+
+        yield page
 
         logger.debug('[PROM.UA] done')
         offset += limit
-        time.sleep(delay)
 
     logger.info('[PROM.UA] Fetching data from ' + platform_name + ' done')
+
+
+def search_query(query: str, timeout: int = 60 * 5, log_queries: bool = False) -> dict:
+    result_data = {'products': [], 'timestamp': time.time()}
+
+    for page in iter_pages(query, timeout, log_queries):
+        result_data['products'].extend(page)
+
     return result_data
 
 # print(search_query('Чохол для iPhone 12 Pro Max'))
@@ -1,69 +1,188 @@
-import json
+import asyncio
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
-import requests
+import aiohttp
+
+import codec
+import http_sessions
 
 platform_name = 'rozetka'
 url = 'https://search.rozetka.com.ua/ua/search/api/v6/'
 params = {'country': 'UA', 'lang': 'ua'}
+# Starting requests per second, tuned by the rate limiter afterwards
+rate_limit = 4
+
+# Number of pages fetched at the same time once the total number of pages is known
+page_concurrency = 8
 
 log_dir = f'platforms/fetched/{platform_name}/'
 logger = logging.getLogger(platform_name)
 
 
-def search_query(query: str, timeout: int = 30, log_queries: bool = False) -> dict:
+def parse_products(data: dict) -> [dict]:
+    return [{
+        'id': product['id'],
+        'name': product['title'],
+        'href': product['href'],
+        'img_href': product['image_main'],
+        'brand': product['brand'],
+        'price': product['price'],
+        'in_stock': product['status'] and product['status'] == 'available'
+    } for product in data['goods']]
+
+
+def save_response(query: str, page: int, data: dict):
+    os.makedirs(log_dir, exist_ok=True)
+    codec.dump(data, os.path.join(log_dir, f'{query}-{page}-{time.time()}.json'))
+
+
+def fetch_page(query: str, page: int, log_queries: bool = False) -> dict:
+    logger.debug('[ROZETKA] page: ' + str(page))
+
+    response = http_sessions.get_session(url).get(url, params=dict(params, text=query, page=page))
+    if response.status_code != 200:
+        raise Exception('Failed to fetch data:', response.status_code, response.text)
+
+    # Parse the JSON response
+    data = codec.loads(response.content)
+
+    # Save the response to a file
+    if log_dir and log_queries:
+        save_response(query, page, data)
+
+    logger.debug('[ROZETKA] fetch page done')
+    return data['data']
+
+
+async def fetch_page_async(session: aiohttp.ClientSession, query: str, page: int, log_queries: bool = False) -> dict:
+    logger.debug('[ROZETKA] page: ' + str(page))
+
+    status, body = await http_sessions.request_async(session, 'GET', url, params=dict(params, text=query, page=page))
+    if status != 200:
+        raise Exception('Failed to fetch data:', status, body.decode(errors='replace'))
+
+    # Parse the JSON response
+    data = codec.loads(body)
+
+    # Save the response to a file
+    if log_dir and log_queries:
+        save_response(query, page, data)
+
+    logger.debug('[ROZETKA] fetch page done')
+    return data['data']
+
+
+def iter_pages(query: str, timeout: int = 30, log_queries: bool = False, result_data: dict = None):
+    """
+    Yield the products of each fetched page in page order.
+
+    Pages that fail or are still pending at the timeout are skipped, `result_data` is then marked partial.
+    """
     logger.info('[ROZETKA] Fetching data from ' + platform_name)
     logger.debug('[ROZETKA] Query: ' + query)
 
-    params['text'] = query
-    result_data = {'products': [], 'timestamp': time.time()}
-    current_page = 1
+    timer = time.time()
+
+    # The first page tells the total number of pages
+    data = fetch_page(query, 1, log_queries)
+    total_pages = data['pagination']['total_pages']
+    yield parse_products(data)
+
+    if total_pages > 1:
+        missing = 0
+        executor = ThreadPoolExecutor(max_workers=page_concurrency)
+        futures = [executor.submit(fetch_page, query, page, log_queries) for page in range(2, total_pages + 1)]
+
+        try:
+            for page, future in enumerate(futures, start=2):
+                try:
+                    yield parse_products(future.result(timeout=max(timeout - (time.time() - timer), 0)))
+                except TimeoutError:
+                    logger.warning('[ROZETKA] Timeout reached')
+                    missing += len(futures) - page + 2
+                    break
+                except Exception as e:
+                    logger.warning('[ROZETKA] Page ' + str(page) + ' error: ' + str(e))
+                    missing += 1
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if missing:
+            logger.warning('[ROZETKA] ' + str(missing) + ' of ' + str(total_pages) + ' pages missing')
+            if result_data is not None:
+                result_data['partial'] = True
+
+    logger.info('[ROZETKA] Fetching data from ' + platform_name + ' done')
+
+
+async def iter_pages_async(query: str, session: aiohttp.ClientSession, timeout: int = 30, log_queries: bool = False,
+                           result_data: dict = None):
+    """
+    Yield the products of each fetched page in page order.
+
+    Pages that fail or are still pending at the timeout are skipped, `result_data` is then marked partial.
+    """
+    logger.info('[ROZETKA] Fetching data from ' + platform_name)
+    logger.debug('[ROZETKA] Query: ' + query)
 
     timer = time.time()
 
-    while True:
-        logger.debug('[ROZETKA] page: ' + str(current_page))
-        params['page'] = current_page
-
-        response = requests.get(url, params=params)
-        if response.status_code != 200:
-            raise Exception('Failed to fetch data:', response.status_code, response.text)
-
-        # Parse the JSON response
-        data = response.json()
-
-        # Save the response to a file
-        if log_dir and log_queries:
-            os.makedirs(log_dir, exist_ok=True)
-            with open(os.path.join(log_dir, f'{query}-{current_page}-{time.time()}.json'), 'w') as f:
-                json.dump(data, f, indent=2)
-
-        # Process the JSON data
-        data = data['data']
-        products = data['goods']
-        logger.debug('[ROZETKA] products count: ' + str(len(products)))
-        for product in products:
-            result_data['products'].append({
-                'id': product['id'],
-                'name': product['title'],
-                'href': product['href'],
-                'img_href': product['image_main'],
-                'brand': product['brand'],
-                'price': product['price'],
-                'in_stock': product['status'] and product['status'] == 'available'
-            })
-
-        if current_page >= data['pagination']['total_pages']:
-            break
-
-        if time.time() - timer >= timeout:
-            logger.warning('[ROZETKA] Timeout reached')
-            raise Exception('Timeout reached')
-
-        logger.debug('[ROZETKA] fetch page done')
-        current_page += 1
+    # The first page tells the total number of pages
+    data = await fetch_page_async(session, query, 1, log_queries)
+    total_pages = data['pagination']['total_pages']
+    yield parse_products(data)
+
+    if total_pages > 1:
+        missing = 0
+        semaphore = asyncio.Semaphore(page_concurrency)
+
+        async def fetch(page: int) -> dict:
+            async with semaphore:
+                return await fetch_page_async(session, query, page, log_queries)
+
+        tasks = [asyncio.create_task(fetch(page)) for page in range(2, total_pages + 1)]
+
+        try:
+            for page, task in enumerate(tasks, start=2):
+                try:
+                    yield parse_products(await asyncio.wait_for(asyncio.shield(task),
+                                                                max(timeout - (time.time() - timer), 0)))
+                except asyncio.TimeoutError:
+                    logger.warning('[ROZETKA] Timeout reached')
+                    missing += len(tasks) - page + 2
+                    break
+                except Exception as e:
+                    logger.warning('[ROZETKA] Page ' + str(page) + ' error: ' + str(e))
+                    missing += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if missing:
+            logger.warning('[ROZETKA] ' + str(missing) + ' of ' + str(total_pages) + ' pages missing')
+            if result_data is not None:
+                result_data['partial'] = True
 
     logger.info('[ROZETKA] Fetching data from ' + platform_name + ' done')
+
+
+def search_query(query: str, timeout: int = 30, log_queries: bool = False) -> dict:
+    result_data = {'products': [], 'timestamp': time.time()}
+
+    for page in iter_pages(query, timeout, log_queries, result_data):
+        result_data['products'].extend(page)
+
+    return result_data
+
+
+async def search_query_async(query: str, session: aiohttp.ClientSession, timeout: int = 30,
+                             log_queries: bool = False) -> dict:
+    result_data = {'products': [], 'timestamp': time.time()}
+
+    async for page in iter_pages_async(query, session, timeout, log_queries, result_data):
+        result_data['products'].extend(page)
+
     return result_data
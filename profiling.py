@@ -0,0 +1,181 @@
+"""
+On-demand profiling of update runs.
+
+Profiling is enabled from the API for the next N runs. A profiled run records a timeline of spans, run → job
+(platform, query) → page fetch, JSON decode and ingest batch → DB queue wait and write, written as a Chrome trace
+(open it in Perfetto or chrome://tracing). Spans follow the run across tasks and threads through context variables,
+every job is drawn on its own lane. With sampling, a background thread also samples the stacks of all threads and
+writes them in the folded format of flame graph tools.
+
+When profiling is off, `span` only costs a context variable lookup.
+"""
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from types import FrameType
+
+PROFILES_DIR: str = os.getenv('PROFILES_DIR', 'profiles/')
+# Profiles kept on disk, older ones are deleted
+PROFILES_KEPT = 20
+SAMPLE_INTERVAL = 0.01  # Seconds
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of all other threads every `interval` seconds and counts identical stacks."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        super().__init__(name='profiling-sampler', daemon=True)
+        self.interval: float = interval
+        self.stacks: dict[str, int] = {}
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def folded(thread_name: str, frame: FrameType) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        return ';'.join([thread_name] + frames[::-1])
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+
+                stack = self.folded(names.get(ident, str(ident)), frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class RunProfile:
+    def __init__(self, name: str, sample: bool):
+        self.name: str = name
+        self.started: float = time.time()
+        self.origin: float = time.perf_counter()
+
+        self.events: [dict] = []
+        self.lanes = itertools.count(1)
+        self.lock = threading.Lock()
+
+        self.sampler: Sampler | None = Sampler() if sample else None
+        if self.sampler:
+            self.sampler.start()
+
+    def record(self, name: str, start: float, end: float, lane: int, **attributes):
+        """Add a span, `start` and `end` are `time.perf_counter()` values."""
+        event = {'name': name, 'ph': 'X', 'pid': 1, 'tid': lane, 'ts': round((start - self.origin) * 1e6),
+                 'dur': round((end - start) * 1e6), 'args': attributes}
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, profiles_dir: str = PROFILES_DIR) -> [str]:
+        """Write the trace, and the folded stacks when sampling, returns the file names."""
+        if self.sampler:
+            self.sampler.stop()
+
+        os.makedirs(profiles_dir, exist_ok=True)
+        files = [f'{self.name}.trace.json']
+        with open(os.path.join(profiles_dir, files[0]), 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                       'otherData': {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.started))}}, f)
+
+        if self.sampler:
+            files.append(f'{self.name}.folded')
+            with open(os.path.join(profiles_dir, files[1]), 'w') as f:
+                for stack, count in sorted(self.sampler.stacks.items()):
+                    f.write(f'{stack} {count}\n')
+
+        return files
+
+
+current_profile: ContextVar[RunProfile | None] = ContextVar('current_profile', default=None)
+current_lane: ContextVar[int] = ContextVar('current_lane', default=0)
+
+runs_left: int = 0
+sample: bool = False
+lock = threading.Lock()
+
+
+def enable(runs: int, with_sampling: bool = False):
+    global runs_left, sample
+    with lock:
+        runs_left = runs
+        sample = with_sampling
+
+
+def disable():
+    enable(0)
+
+
+def start_run() -> RunProfile | None:
+    """Profile of the next run if profiling is enabled for it, None otherwise."""
+    global runs_left
+    with lock:
+        if runs_left <= 0:
+            return None
+        runs_left -= 1
+
+        return RunProfile(f'profile-{time.strftime("%Y%m%d-%H%M%S")}-{time.time_ns() % 1000000:06d}', sample)
+
+
+def activate(profile: RunProfile | None):
+    """Record the spans of the current context, and of the tasks and threads it starts, into `profile`."""
+    current_profile.set(profile)
+
+
+def finish_run(profile: RunProfile, profiles_dir: str = PROFILES_DIR) -> [str]:
+    files = profile.save(profiles_dir)
+    print('Profile saved:', ', '.join(files))
+
+    # Keep the newest profiles only
+    names = sorted({file.split('.')[0] for file in os.listdir(profiles_dir) if file.startswith('profile-')})
+    for name in names[:-PROFILES_KEPT]:
+        for file in os.listdir(profiles_dir):
+            if file.startswith(name + '.'):
+                os.remove(os.path.join(profiles_dir, file))
+
+    return files
+
+
+@contextmanager
+def _span(profile: RunProfile, name: str, new_lane: bool, attributes: dict):
+    token = current_lane.set(next(profile.lanes)) if new_lane else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.record(name, start, time.perf_counter(), current_lane.get(), **attributes)
+        if token:
+            current_lane.reset(token)
+
+
+def span(name: str, new_lane: bool = False, **attributes):
+    """Context manager timing a span of the profiled run, a no-op when the current run is not profiled."""
+    profile = current_profile.get()
+    if profile is None:
+        return nullcontext()
+    return _span(profile, name, new_lane, attributes)
+
+
+def record(name: str, start: float, end: float, **attributes):
+    """Add an already timed span to the profiled run, `start` and `end` are `time.perf_counter()` values."""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.record(name, start, end, current_lane.get(), **attributes)
+
+
+def list_profiles(profiles_dir: str = PROFILES_DIR) -> [str]:
+    if not os.path.isdir(profiles_dir):
+        return []
+    return sorted(file for file in os.listdir(profiles_dir) if file.startswith('profile-'))
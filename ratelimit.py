@@ -0,0 +1,156 @@
+"""
+Adaptive per-platform request rate limiting.
+
+Every platform host has one token bucket shared by all queries and pages fetched from it, sync and async alike.
+The rate is tuned with AIMD: it grows additively while requests succeed and is cut multiplicatively when the remote
+side pushes back with 429 or 5xx, which also pauses the bucket for the `Retry-After` time or an exponential backoff.
+"""
+import asyncio
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+initial_rate: float = float(os.getenv('RATE_LIMIT_INITIAL', 2))  # Requests per second
+min_rate: float = float(os.getenv('RATE_LIMIT_MIN', 0.2))
+max_rate: float = float(os.getenv('RATE_LIMIT_MAX', 20))
+burst: float = float(os.getenv('RATE_LIMIT_BURST', 2))
+# Rate gained per second of successful requests and factor applied on a throttle
+increase: float = 0.5
+decrease: float = 0.5
+backoff_factor: float = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+max_backoff: float = 60
+
+throttle_statuses = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait from a `Retry-After` header, given as seconds or as an HTTP date."""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    def __init__(self, name: str, rate: float = None):
+        self.name: str = name
+        self.platform: str | None = None
+        self.rate: float = rate or initial_rate
+
+        self.tokens: float = burst
+        # Time the tokens were last refilled, in the future while backing off
+        self.updated: float = time.monotonic()
+        self.throttled: int = 0  # Consecutive throttles
+
+        self.requests: int = 0
+        self.throttles: int = 0
+        self.waited: float = 0.0
+
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self) -> float:
+        """Take a token, returns how long to wait before sending the request."""
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+
+            self.tokens -= 1
+            wait = (self.updated - now) + max(0.0, -self.tokens) / self.rate
+
+            self.requests += 1
+            self.waited += wait
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.throttled = 0
+            # Additive increase, about `increase` requests/s more per second of successful requests
+            self.rate = min(max_rate, self.rate + increase / self.rate)
+
+    def on_throttle(self, retry_after: float = None):
+        with self.lock:
+            now = time.monotonic()
+
+            # Requests already in flight when the bucket was paused only count once
+            if now >= self.updated:
+                self.refill(now)
+                self.rate = max(min_rate, self.rate * decrease)
+
+            backoff = retry_after if retry_after is not None else backoff_factor * 2 ** self.throttled
+            self.throttled += 1
+            self.throttles += 1
+
+            # Pause the bucket, refilling starts again once the backoff is over
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = max(self.updated, now + min(backoff, max_backoff))
+
+    def on_response(self, status: int, retry_after: str = None) -> bool:
+        """Adapt to a response status, returns True if the request was throttled and should be retried."""
+        if status in throttle_statuses:
+            self.on_throttle(parse_retry_after(retry_after))
+            return True
+
+        self.on_success()
+        return False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'host': self.name,
+                'rate': round(self.rate, 3),
+                'backoff': round(max(self.updated - time.monotonic(), 0.0), 3),
+                'requests': self.requests,
+                'throttles': self.throttles,
+                'waited': round(self.waited, 3),
+            }
+
+
+limiters: dict[str, RateLimiter] = {}
+lock = threading.Lock()
+
+
+def get_limiter(host: str) -> RateLimiter:
+    with lock:
+        if host not in limiters:
+            limiters[host] = RateLimiter(host)
+        return limiters[host]
+
+
+def register(platform: str, host: str, rate: float = None) -> RateLimiter:
+    """Name the limiter of a platform host, platform modules may set their own starting `rate_limit`."""
+    limiter = get_limiter(host)
+    if limiter.platform is None:
+        limiter.platform = platform
+        if rate:
+            limiter.rate = rate
+    return limiter
+
+
+def get_rates() -> dict[str, dict]:
+    """Current rate and throttling statistics of every platform, by platform name (host if unnamed)."""
+    with lock:
+        return {limiter.platform or host: limiter.stats() for host, limiter in limiters.items()}
@@ -0,0 +1,43 @@
+"""
+Adaptive refresh intervals of (platform, query) schedules.
+
+Every (platform, query) pair has its own schedule in the `schedules` table. After each run, the interval follows the
+share of goods seen before whose price or stock status changed: it is shortened when the share reaches
+`SPEED_UP_SHARE`, lengthened when it stays under `BACK_OFF_SHARE` and kept in between, within the
+`MinUpdateInterval` and `MaxUpdateInterval` bounds, so scraping follows where the changes happen. First-seen goods are
+not changes, a large query always has a few. Pinned schedules keep their interval.
+"""
+import calendar
+import time
+from datetime import datetime
+
+# Interval factor after a run with changes and after a run without
+SPEED_UP = 0.5
+BACK_OFF = 1.5
+# Shares of changed goods that shorten and lengthen the interval
+SPEED_UP_SHARE = 0.05
+BACK_OFF_SHARE = 0.01
+
+
+def next_interval(interval: int, changes: int, known: int, min_interval: int, max_interval: int) -> int:
+    """Interval in minutes for the next run after a run that found `changes` changed goods out of `known` goods."""
+    # Nothing to compare against, e.g. on the first run of a query
+    if known:
+        share = changes / known
+        if share >= SPEED_UP_SHARE:
+            interval = interval * SPEED_UP
+        elif share < BACK_OFF_SHARE:
+            interval = interval * BACK_OFF
+
+    return int(min(max(round(interval), min_interval), max_interval))
+
+
+def db_time(timestamp: float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
+def from_db_time(value: str | datetime) -> float:
+    # SQLite returns timestamps as strings, MySQL as datetimes
+    if isinstance(value, datetime):
+        return calendar.timegm(value.timetuple())
+    return calendar.timegm(time.strptime(value, '%Y-%m-%d %H:%M:%S'))
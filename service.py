@@ -1,32 +1,46 @@
+import base64
 import logging
 import os
 import time
+from datetime import datetime, timezone
 from threading import Thread
 
 import schedule
 import uvicorn
 import yaml
-from fastapi import FastAPI
+from fastapi import FastAPI, Query, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse, Response
+from pydantic import BaseModel
+from starlette.responses import FileResponse, Response, StreamingResponse, PlainTextResponse
 
+import codec
 import config
 import exporter
+import http_sessions
+import metrics
+import profiling
+import ratelimit
+import stats
 import worker
-from db import SqLiteDB, MySQLDB
+from db import SqLiteDB, MySQLDB, AsyncDB
 
 start_time = time.time()
-update_count = 0
 
 debug: bool = os.getenv('DEBUG', 'false').lower() == 'true'
 config_file: str = os.getenv('CONFIG_FILE', 'config.ini')
 
 db_type: str = os.getenv('DB_TYPE', 'sqlite').lower()
 
+# History storage mode: 'full' or 'delta' (store prices and stock statuses only when they change)
+history_mode: str = os.getenv('HISTORY_MODE', 'full').lower()
+# Compact existing history on startup (one-off migration to delta mode)
+compact_history: bool = os.getenv('COMPACT_HISTORY', 'false').lower() == 'true'
+
 if db_type == 'sqlite':
     db_dir: str = os.getenv('DB_DIR', 'db/')
     db_name: str = os.getenv('DB_NAME', 'project-d-db.sqlite')
-    db = SqLiteDB(db_name, db_dir)
+    db_readers: int = int(os.getenv('SQLITE_READERS', 4))
+    db = SqLiteDB(db_name, db_dir, history_mode, db_readers)
 elif db_type == 'mysql':
     # DB connection parameters
     db_host: str = os.getenv('MYSQL_ADDR', '127.0.0.1')
@@ -34,20 +48,27 @@ elif db_type == 'mysql':
     db_user: str = os.getenv('MYSQL_USER', 'root')
     db_password: str = os.getenv('MYSQL_PASSWORD')
     db_database: str = os.getenv('MYSQL_DB', 'project-d-db')
+    db_pool_size: int = int(os.getenv('MYSQL_POOL_SIZE', 8))
 
     # Initialize DB
-    db = MySQLDB(db_host, db_port, db_user, db_password, db_database)
+    db = MySQLDB(db_host, db_port, db_user, db_password, db_database, history_mode, db_pool_size)
 else:
     print('Invalid DB_TYPE:', db_type)
     exit(0)
 
+# Awaitable DB access for the API
+adb = AsyncDB(db, int(os.getenv('ASYNC_DB_WORKERS', 8)))
+statistics = stats.statistics
+statistics.db = db
+statistics.ttl = int(os.getenv('STATS_TTL', stats.STATS_TTL))
+
 # API parameters
 api_host: str = os.getenv('API_ADDR', '0.0.0.0')
 api_port: int = int(os.getenv('API_PORT', 8000))
 root_path: str = '' if debug else os.getenv('API_ROOT_PATH', '/api')
 
 # Initialize FastAPI
-api = FastAPI(root_path=root_path)
+api = FastAPI(root_path=root_path, default_response_class=codec.JSONResponse)
 
 if debug:
     print('Adding CORS middleware...')
@@ -62,6 +83,18 @@ if debug:
 platforms_dir = 'platforms/'
 
 
+@api.middleware('http')
+async def measure_request(request: Request, call_next):
+    timer = time.perf_counter()
+    response = await call_next(request)
+
+    # Route template, e.g. /db/prices/{good_id}, keeps the number of label values bounded
+    route = request.scope.get('route')
+    metrics.api_request_seconds.observe(time.perf_counter() - timer, route=route.path if route else 'unmatched',
+                                        method=request.method, status=response.status_code)
+    return response
+
+
 @api.get("/")
 async def root():
     return {"message": "Service is running..."}
@@ -87,43 +120,155 @@ async def get_db_type():
 
 @api.get("/db/queries")
 async def get_queries():
-    return db.get_queries()
+    return await adb.get_queries()
 
 
 @api.get("/db/queries/active")
 async def get_active_queries():
-    return {"rows": db.get_active_queries()}
+    return {"rows": await adb.get_active_queries()}
 
 
 @api.get("/db/query/{query_id}/active/{active}")
 async def set_query_status(query_id: int, active: bool):
-    db.set_query_status(query_id, active)
+    await adb.set_query_status(query_id, active)
     return {'status': 'ok', 'query_id': query_id, 'active': active}
 
 
 @api.get("/db/queries/add-query/{query}")
 async def add_query(query: str):
-    return {'status': 'ok', 'query': query, 'query_id': db.add_query(query)}
+    return {'status': 'ok', 'query': query, 'query_id': await adb.add_query(query)}
 
 
 @api.get("/platforms")
 async def get_platforms():
-    return [platform[0] for platform in worker.list_platforms(platforms_dir)]
+    # The registry may stat and reload platform files, off the event loop
+    platforms = await adb.run(worker.list_platforms, platforms_dir)
+    return [platform[0] for platform in platforms]
+
+
+@api.get("/platforms/rate-limits")
+async def get_rate_limits():
+    return ratelimit.get_rates()
+
+
+def encode_cursor(after_id: int) -> str:
+    return base64.urlsafe_b64encode(str(after_id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def to_db_timestamp(date_time: datetime | None) -> str | None:
+    if not date_time:
+        return None
+
+    if date_time.tzinfo:
+        date_time = date_time.astimezone(timezone.utc)
+    return date_time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+BUCKET_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+
+
+def parse_bucket(bucket: str | None) -> int | None:
+    """Parse a bucket size like '15m', '1h' or '1d' into seconds."""
+    if not bucket:
+        return None
+
+    try:
+        seconds = int(bucket[:-1]) * BUCKET_UNITS[bucket[-1]]
+    except (ValueError, KeyError):
+        raise HTTPException(status_code=400, detail='Invalid bucket, expected e.g. 15m, 1h or 1d')
+
+    if seconds <= 0:
+        raise HTTPException(status_code=400, detail='Bucket must be positive')
+    return seconds
 
 
 @api.get("/db/goods")
-async def get_goods():
-    return db.get_goods()
+async def get_goods(platform: str = None, query_id: int = None, brand: str = None, updated_since: datetime = None,
+                    cursor: str = None, limit: int = Query(100, ge=1, le=1000)):
+    # The total count is only computed for the first page
+    rows, has_next, total = await adb.get_goods_page(platform, query_id, brand, to_db_timestamp(updated_since),
+                                                     decode_cursor(cursor) if cursor else None, limit,
+                                                     with_total=not cursor)
+
+    # Rendered directly by the codec, the rows need no jsonable_encoder pass
+    return codec.JSONResponse({'rows': rows,
+                               'next_cursor': encode_cursor(rows[-1][0]) if has_next else None,
+                               'total_count': total})
+
+
+def parse_good_ids(good_ids: str) -> [int]:
+    try:
+        return [int(good_id) for good_id in good_ids.split(',') if good_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid good_ids, expected comma separated ids')
+
+
+@api.get("/db/prices")
+async def get_prices_batch(good_ids: str, start: datetime = Query(None, alias='from'),
+                           end: datetime = Query(None, alias='to')):
+    return codec.JSONResponse(await adb.get_prices_batch(parse_good_ids(good_ids), to_db_timestamp(start),
+                                                         to_db_timestamp(end)))
+
+
+@api.get("/db/in-stock")
+async def get_in_stock_batch(good_ids: str, start: datetime = Query(None, alias='from'),
+                             end: datetime = Query(None, alias='to')):
+    return codec.JSONResponse(await adb.get_in_stock_batch(parse_good_ids(good_ids), to_db_timestamp(start),
+                                                           to_db_timestamp(end)))
+
+
+class HistoryRequest(BaseModel):
+    good_ids: list[int]
+    start: datetime | None = None
+    end: datetime | None = None
+
+
+@api.post("/db/history")
+async def get_history(request: HistoryRequest):
+    prices = await adb.get_prices_batch(request.good_ids, to_db_timestamp(request.start),
+                                        to_db_timestamp(request.end))
+    in_stock = await adb.get_in_stock_batch(request.good_ids, to_db_timestamp(request.start),
+                                            to_db_timestamp(request.end))
+
+    # One JSON line per good
+    def lines():
+        for good_id in prices:
+            yield codec.dumps({'good_id': good_id, 'prices': prices[good_id],
+                               'in_stock': in_stock.get(good_id, [])}) + b'\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
 
 
 @api.get("/db/prices/{good_id}")
-async def get_prices(good_id: int):
-    return db.get_prices(good_id)
+async def get_prices(good_id: int, start: datetime = Query(None, alias='from'), end: datetime = Query(None, alias='to'),
+                     bucket: str = None):
+    bucket_seconds = parse_bucket(bucket)
+    rows = await adb.get_prices(good_id, to_db_timestamp(start), to_db_timestamp(end), bucket_seconds)
+
+    if not bucket_seconds:
+        return rows
+
+    return [{'timestamp': row[0], 'min': row[1], 'max': row[2], 'avg': row[3], 'last': row[4], 'samples': row[5]}
+            for row in rows]
 
 
 @api.get("/db/in-stock/{good_id}")
-async def get_in_stock(good_id: int):
-    return db.get_in_stock(good_id)
+async def get_in_stock(good_id: int, start: datetime = Query(None, alias='from'),
+                       end: datetime = Query(None, alias='to'), bucket: str = None):
+    bucket_seconds = parse_bucket(bucket)
+    rows = await adb.get_in_stock(good_id, to_db_timestamp(start), to_db_timestamp(end), bucket_seconds)
+
+    if not bucket_seconds:
+        return rows
+
+    return [{'timestamp': row[0], 'in_stock': row[1], 'last': row[2], 'samples': row[3]} for row in rows]
 
 
 @api.get("/settings/update-interval")
@@ -133,14 +278,38 @@ async def get_update_interval():
 
 @api.get("/settings/update-interval/{interval}")
 async def set_update_interval(interval: int):
+    if interval <= 0:
+        raise HTTPException(status_code=400, detail='Interval must be positive')
+
     config.write_config_value('UpdateInterval', str(interval))
-    return {'update_interval': config.read_config_value('UpdateInterval')}
+
+    # Reschedule the running schedules, no restart needed
+    updated = await adb.run(worker.apply_update_interval, db, True)
+    return {'update_interval': config.read_config_value('UpdateInterval'), 'schedules_updated': updated}
+
+
+@api.get("/schedules")
+async def get_schedules():
+    return [{'platform': row[0], 'query_id': row[1], 'interval': row[2], 'pinned': bool(row[3]), 'next_run': row[4],
+             'last_run': row[5], 'last_changes': row[6]} for row in await adb.get_schedules()]
+
+
+@api.get("/schedules/pin/{interval}")
+async def pin_schedules(interval: int, platform: str = None, query_id: int = None):
+    if interval <= 0:
+        raise HTTPException(status_code=400, detail='Interval must be positive')
+    return {'status': 'ok', 'pinned': await adb.pin_schedules(interval, platform, query_id)}
+
+
+@api.get("/schedules/unpin")
+async def unpin_schedules(platform: str = None, query_id: int = None):
+    return {'status': 'ok', 'unpinned': await adb.pin_schedules(None, platform, query_id)}
 
 
 @api.get("/export/csv")
 async def export_to_csv():
     file_name = f'export-{time.strftime("%Y-%m-%d %H-%M-%S")}.csv'
-    exported = exporter.export_to_csv(db, file_name=file_name, file_path='export/')
+    exported = await adb.run(exporter.export_to_csv, db, file_name=file_name, file_path='export/')
     if exported:
         return FileResponse(exported, media_type='text/csv', filename=file_name)
     else:
@@ -150,7 +319,7 @@ async def export_to_csv():
 @api.get("/export/xlsx")
 async def export_to_xlsx():
     file_name = f'export-{time.strftime("%Y-%m-%d %H-%M-%S")}.xlsx'
-    exported = exporter.export_to_xlsx(db, file_name=file_name, file_path='export/')
+    exported = await adb.run(exporter.export_to_xlsx, db, file_name=file_name, file_path='export/')
     if exported:
         return FileResponse(exported, media_type='application/vnd.ms-excel',
                             filename=file_name)
@@ -164,6 +333,7 @@ async def export_sqlite_db():
         db_file = os.path.join(db_dir, db_name)
         if not os.path.exists(db_file):
             return {'status': 'error', 'message': 'DB file not found'}
+        await adb.checkpoint()
         return FileResponse(db_file, media_type='application/x-sqlite3', filename=db_name)
     else:
         return {'status': 'error', 'message': 'DB_TYPE is not sqlite'}
@@ -180,15 +350,54 @@ async def restart_service():
 
 @api.get("/statistics")
 async def get_statistics():
+    # Cached counts, refreshed in the background once stale
+    snapshot = statistics.snapshot()
+    platforms = await adb.run(worker.list_platforms, platforms_dir)
+
     return {'running_time': round(time.time() - start_time, 2),
-            'update_count': update_count,
+            'update_count': statistics.update_count,
             'update_interval': config.read_config_value('UpdateInterval'),
-            'platforms_count': len(worker.list_platforms(platforms_dir)),
-            'queries_count': len(db.get_queries()),
-            'goods_count': len(db.get_goods()),
+            'platforms_count': len(platforms),
+            'queries_count': snapshot['rows'].get('tracked_queries', 0),
+            'goods_count': snapshot['rows'].get('goods', 0),
+            **snapshot,
             }
 
 
+@api.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@api.get("/profiling")
+async def get_profiling():
+    return {'runs_left': profiling.runs_left, 'sample': profiling.sample, 'profiles': profiling.list_profiles()}
+
+
+@api.get("/profiling/enable/{runs}")
+async def enable_profiling(runs: int, sample: bool = False):
+    if runs <= 0:
+        raise HTTPException(status_code=400, detail='Runs must be positive')
+    profiling.enable(runs, sample)
+    return {'status': 'ok', 'runs_left': runs, 'sample': sample}
+
+
+@api.get("/profiling/disable")
+async def disable_profiling():
+    profiling.disable()
+    return {'status': 'ok'}
+
+
+@api.get("/profiling/profiles/{name}")
+async def get_profile(name: str):
+    # Only files written by the profiler
+    if name not in profiling.list_profiles():
+        raise HTTPException(status_code=404, detail='Profile not found')
+
+    media_type = 'application/json' if name.endswith('.json') else 'text/plain'
+    return FileResponse(os.path.join(profiling.PROFILES_DIR, name), media_type=media_type, filename=name)
+
+
 @api.get("/log")
 async def get_log():
     if not debug:
@@ -211,6 +420,16 @@ def run_api():
 def init():
     print('project-d service is initializing...')
     db.db_init()
+
+    if compact_history and history_mode == 'delta':
+        db.compact_history()
+
+    # Load the platform plugins once, later calls only reload changed files
+    worker.list_platforms(platforms_dir)
+
+    # First row counts, so /statistics never waits for them
+    statistics.refresh_if_stale()
+
     print('project-d service is initialized.')
 
     # # Export the DB to CSV and XLSX. Test
@@ -230,9 +449,9 @@ if __name__ == '__main__':
     api_thread = Thread(target=run_api, daemon=True)
     api_thread.start()
 
-    # Schedule the job to run every minute
-    schedule.every(int(config.read_config_value('UpdateInterval'))).minutes.do(worker.update_db, db, platforms_dir)
-    print('DB update scheduled. Interval:', config.read_config_value('UpdateInterval'), 'minutes')
+    # Check the per-query refresh schedules every minute
+    schedule.every(1).minutes.do(worker.update_db, db, platforms_dir)
+    print('DB update scheduled. Default interval:', config.read_config_value('UpdateInterval'), 'minutes')
     print('--' * 50)
     print('')
 
@@ -254,6 +473,9 @@ if __name__ == '__main__':
         print('keyboard interrupt')
     finally:
         print('project-d service is stopping...')
+        worker.fetch_engine.stop()
+        http_sessions.close_sessions()
+        adb.close()
         db.db_close()
         print('project-d service stopped.')
         exit(0)
@@ -0,0 +1,102 @@
+"""
+Service statistics served by `/statistics` in constant time.
+
+Row counts come from `COUNT(*)` queries cached for `ttl` seconds. Between refreshes, ingests add the rows they write
+to the cached counts. A stale cache is refreshed on a background thread while the last values keep being served, so
+no request waits for a count. Update runs record the duration of every platform and the products fetched per query.
+
+The process-wide `statistics` lives here rather than in `service`, which runs as `__main__`: an `import service` from
+the worker would load a second service with its own DB and statistics.
+"""
+import threading
+import time
+
+from db import DB
+
+STATS_TTL = 30
+
+
+class Statistics:
+    def __init__(self, db: DB = None, ttl: float = STATS_TTL):
+        self.db: DB | None = db
+        self.ttl: float = ttl
+
+        self.rows: dict[str, int] = {}
+        self.goods_per_query: dict[(str, int), int] = {}
+        self.refreshed: float = 0
+        self.refreshing: bool = False
+
+        # Last update run of every platform and products fetched by the last run of every (platform, query)
+        self.platform_runs: dict[str, dict] = {}
+        self.query_products: dict[(str, int), int] = {}
+        self.update_count: int = 0
+
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            rows = self.db.count_rows()
+            goods_per_query = self.db.count_goods_per_query()
+
+            with self.lock:
+                self.rows = rows
+                self.goods_per_query = goods_per_query
+                self.refreshed = time.time()
+        finally:
+            self.refreshing = False
+
+    def refresh_if_stale(self):
+        with self.lock:
+            # No DB set up yet
+            if self.db is None or self.refreshing or time.time() - self.refreshed < self.ttl:
+                return
+            self.refreshing = True
+            first = not self.refreshed
+
+        if first:
+            # Nothing to serve yet
+            self.refresh()
+        else:
+            threading.Thread(target=self.refresh, name='stats-refresh', daemon=True).start()
+
+    def record_ingest(self, platform: str, query_id: int, stats: dict):
+        """Add the rows written by an ingest to the cached counts."""
+        with self.lock:
+            if not self.rows:
+                return
+
+            for table, count in (('goods', stats['new_goods']), ('prices', stats['prices']),
+                                 ('in_stock', stats['in_stock'])):
+                self.rows[table] = self.rows.get(table, 0) + count
+            self.goods_per_query[(platform, query_id)] = \
+                self.goods_per_query.get((platform, query_id), 0) + stats['new_goods']
+
+    def record_products(self, platform: str, query_id: int, products: int):
+        with self.lock:
+            self.query_products[(platform, query_id)] = products
+
+    def record_platform_run(self, platform: str, seconds: float, jobs: int):
+        with self.lock:
+            self.platform_runs[platform] = {'seconds': round(seconds, 2), 'jobs': jobs, 'finished': time.time()}
+
+    def record_update(self):
+        with self.lock:
+            self.update_count += 1
+
+    def snapshot(self) -> dict:
+        self.refresh_if_stale()
+
+        with self.lock:
+            return {
+                'rows': dict(self.rows),
+                'rows_age': round(time.time() - self.refreshed, 2) if self.refreshed else None,
+                'platform_runs': {platform: dict(run) for platform, run in self.platform_runs.items()},
+                'queries': [{'platform': platform, 'query_id': query_id,
+                             'goods': self.goods_per_query.get((platform, query_id), 0),
+                             'last_products': self.query_products.get((platform, query_id))}
+                            for platform, query_id in sorted(self.goods_per_query.keys() | self.query_products.keys())],
+            }
+
+
+# Set up by the service with its DB, recorded into by the worker
+statistics = Statistics()
@@ -0,0 +1,103 @@
+"""
+API latency while the worker updates the DB.
+
+Runs the API on a uvicorn thread in a temporary working directory, with a SQLite DB and a local fake platform, and
+requests it while `worker.update_db` fetches and ingests the fake products. Requests must keep being answered quickly,
+the blocking DB work runs off the event loop.
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+import requests
+import uvicorn
+
+# Slowest accepted response while the update runs, in seconds
+MAX_LATENCY = 0.5
+
+FAKE_PLATFORM = '''
+import time
+
+url = 'http://fake.invalid'
+rate_limit = 1000
+
+PAGES = 30
+PAGE_SIZE = 2000
+
+
+def iter_pages(query):
+    for page in range(PAGES):
+        time.sleep(0.02)
+        yield [{'id': page * PAGE_SIZE + i, 'name': f'{query} {i}', 'href': f'/goods/{page}/{i}', 'img_href': None,
+                'brand': 'Fake', 'price': 100 + i % 50, 'in_stock': i % 3 != 0} for i in range(PAGE_SIZE)]
+
+
+def search_query(query):
+    return {'products': [product for page in iter_pages(query) for product in page], 'timestamp': time.time()}
+'''
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def service(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('service')
+    (directory / 'platforms').mkdir()
+    (directory / 'platforms' / 'fake.py').write_text(FAKE_PLATFORM)
+
+    with pytest.MonkeyPatch.context() as patch:
+        # config.ini and platforms/ are read from the working directory
+        patch.chdir(directory)
+        patch.setenv('DB_TYPE', 'sqlite')
+        patch.setenv('DB_DIR', str(directory / 'db'))
+        patch.syspath_prepend(os.path.dirname(os.path.abspath(__file__)))
+
+        import service
+        service.init()
+
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(service.api, host='127.0.0.1', port=port, log_level='warning'))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.05)
+
+        yield service, f'http://127.0.0.1:{port}'
+
+        server.should_exit = True
+        thread.join()
+        service.worker.fetch_engine.stop()
+        sys.modules.pop('service', None)
+
+
+def test_api_latency_during_update(service):
+    module, url = service
+
+    update = threading.Thread(target=module.worker.update_db, args=(module.db, module.platforms_dir))
+    update.start()
+
+    latencies = {'/': [], '/db/queries': [], '/db/goods?limit=100': [], '/db/prices/1': []}
+    while update.is_alive():
+        for path, values in latencies.items():
+            timer = time.perf_counter()
+            response = requests.get(url + path, timeout=10)
+            values.append(time.perf_counter() - timer)
+            assert response.status_code == 200, path
+
+    update.join()
+
+    # The update ran and the API was requested while it did
+    assert module.statistics.update_count == 1
+    assert module.db.count_rows()['goods'] > 0
+    assert len(latencies['/']) >= 5
+
+    for path, values in latencies.items():
+        print(path, 'requests:', len(values), 'max:', round(max(values), 3), 's')
+        assert max(values) < MAX_LATENCY, path
@@ -1,13 +1,32 @@
-import json
+import asyncio
 import os
 import threading
 import time
-from datetime import datetime, timezone
 from importlib.util import spec_from_file_location, module_from_spec
 from types import ModuleType
 
-import service
+import codec
+import config
+import crawl
+import metrics
+import profiling
+import ratelimit
+import refresh
 from db import DB
+from engine import FetchEngine, Job
+from stats import statistics
+
+fetch_engine = FetchEngine()
+
+# Fetched pages waiting to be written, the producer waits once the queue is full
+PIPELINE_QUEUE_SIZE = 8
+# Products written to the DB in one transaction
+INGEST_BATCH_SIZE = 500
+# Seconds between checks of the platforms directory for new or changed platform files
+PLATFORMS_CHECK_INTERVAL = 5
+
+# UpdateInterval the schedules were last set to
+update_interval: int | None = None
 
 
 def print_platforms(platforms: [(str, ModuleType)]):
@@ -29,130 +48,338 @@ def load_platform(platform_dir: str) -> ModuleType:
         raise e
 
 
-def list_platforms(platforms_dir: str) -> (str, ModuleType):
-    platforms = []
+class PlatformRegistry:
+    """
+    Platform modules of a directory, loaded once and cached.
 
-    try:
-        for platform_file in os.listdir(platforms_dir):
-            if platform_file.endswith('.py'):
-                try:
-                    platform = platform_file[:-3]  # Remove .py extension
-                    module = load_platform(os.path.join(platforms_dir, platform_file))
+    The directory is checked at most every `check_interval` seconds. A platform file is only executed again when its
+    mtime changes, new files are loaded and removed files are dropped.
+    """
 
-                    if hasattr(module, 'search_query') and callable(module.search_query):
-                        if hasattr(module, 'ready') and not module.ready:
-                            print('Platform', platform, 'is not ready')
-                            continue
+    def __init__(self, platforms_dir: str, check_interval: float = PLATFORMS_CHECK_INTERVAL):
+        self.platforms_dir: str = platforms_dir
+        self.check_interval: float = check_interval
 
-                        platforms.append((platform, module))
+        # Platform file -> (mtime, module or None if it failed to load or is not ready)
+        self.files: dict[str, (float, ModuleType | None)] = {}
+        self.platforms: [(str, ModuleType)] = []
+        self.checked: float = 0
 
-                except Exception as e:
-                    print('Load platform_file', platform_file, 'error:', e)
-                    continue
+        self.lock = threading.Lock()
 
-        print_platforms(platforms)
+    def load(self, platform_file: str) -> ModuleType | None:
+        platform = platform_file[:-3]  # Remove .py extension
+        try:
+            module = load_platform(os.path.join(self.platforms_dir, platform_file))
 
-    except Exception as e:
-        print('List platforms error:', e)
+            if hasattr(module, 'search_query') and callable(module.search_query):
+                if hasattr(module, 'ready') and not module.ready:
+                    print('Platform', platform, 'is not ready')
+                    return None
+
+                return module
+
+        except Exception as e:
+            print('Load platform_file', platform_file, 'error:', e)
+
+        return None
+
+    def refresh(self) -> bool:
+        """Load new and changed platform files, returns True if any platform file changed."""
+        changed = False
+
+        try:
+            mtimes = {platform_file: os.stat(os.path.join(self.platforms_dir, platform_file)).st_mtime
+                      for platform_file in os.listdir(self.platforms_dir) if platform_file.endswith('.py')}
+        except Exception as e:
+            print('List platforms error:', e)
+            return False
+
+        for platform_file in list(self.files):
+            if platform_file not in mtimes:
+                print('Platform file', platform_file, 'removed')
+                del self.files[platform_file]
+                changed = True
+
+        for platform_file, mtime in mtimes.items():
+            if platform_file not in self.files or self.files[platform_file][0] != mtime:
+                self.files[platform_file] = (mtime, self.load(platform_file))
+                changed = True
+
+        if changed:
+            self.platforms = [(platform_file[:-3], module) for platform_file, (mtime, module) in
+                              sorted(self.files.items()) if module is not None]
+            print_platforms(self.platforms)
+
+        return changed
 
-    return platforms
+    def list(self) -> [(str, ModuleType)]:
+        with self.lock:
+            if time.time() - self.checked >= self.check_interval:
+                self.refresh()
+                self.checked = time.time()
 
+            return list(self.platforms)
 
-def update_db_with_fetch_data(db: DB, data: dict, platform: str, query_id: int):
+
+platform_registries: dict[str, PlatformRegistry] = {}
+platform_registries_lock = threading.Lock()
+
+
+def list_platforms(platforms_dir: str) -> (str, ModuleType):
+    with platform_registries_lock:
+        if platforms_dir not in platform_registries:
+            platform_registries[platforms_dir] = PlatformRegistry(platforms_dir)
+        registry = platform_registries[platforms_dir]
+
+    return registry.list()
+
+
+def update_db_with_fetch_data(db: DB, data: dict, platform: str, query_id: int) -> dict | None:
+    """Write fetched products, returns the ingest statistics, None on errors."""
     print('Updating DB with fetched data...')
     print('Products count:', len(data['products']))
 
     try:
-        for good in data['products']:
-            try:
-                good_id = db.get_good_id(good['id'], query_id)
+        stats = db.ingest_snapshot(platform, query_id, data['products'], data['timestamp'])
+        statistics.record_ingest(platform, query_id, stats)
+        print('Ingested goods:', stats['products'], 'skipped:', stats['skipped'], 'new:', stats['new_goods'], 'prices:',
+              stats['prices'], 'in_stock:', stats['in_stock'])
+        print('Ingest rows:', stats['rows'], 'time:', stats['seconds'], 's', 'rate:', stats['rows_per_second'],
+              'rows/s')
 
-                if not good_id:
-                    print('Inserting good:', good['name'])
-                    good_id = db.add_good(platform, good['id'], query_id, good['name'],
-                                          good['href'],
-                                          good['img_href'], good['brand'])
-                else:
-                    good_id = good_id[0][0]
+    except Exception as e:
+        print('Update db with fetched data error:', e)
+        return None
 
-                # Add the price to the prices table
-                print('Inserting price', good['price'], 'for good', good['name'])
-                if good['price']:
-                    db.add_price(good_id, good['price'])
+    print('DB updated with fetched data.')
+    return stats
 
-                # Add the stock status to the in_stock table
-                print('Inserting stock status', good['in_stock'], 'for good', good['name'])
-                db.add_in_stock(good_id, good['in_stock'])
 
-                # Update the last_confirmed field in the goods table
-                db.update_last_confirmed(good_id, datetime.fromtimestamp(data['timestamp'], tz=timezone.utc).strftime(
-                    '%Y-%m-%d %H:%M:%S'))
+async def produce_pages(platform: str, module: ModuleType, query: str, pages: asyncio.Queue):
+    try:
+        async for page in fetch_engine.pages(platform, module, query):
+            await pages.put(page)
+    except asyncio.CancelledError:
+        # Cancelled by the consumer, which no longer reads the queue, so no end marker
+        raise
+    except Exception:
+        # End of the pages after an error, raised again when the consumer awaits the producer
+        await pages.put(None)
+        raise
+
+    # End of the pages
+    await pages.put(None)
+
+
+async def update_query(platform: str, module: ModuleType, query_id: int, query: str, db: DB,
+                       log_dir: str = None) -> tuple[int, int] | None:
+    """
+    Fetch and write a query, returns the number of goods seen before with a changed price or stock status and the
+    number of goods seen before, None if the update failed.
+    """
+    try:
+        print('Warmed goods ids:', await asyncio.to_thread(db.warm_good_ids, platform, query_id))
+
+        # Every batch of the query is stored with the time the fetch started
+        timestamp = time.time()
+        fetched = []
+        seen = set()
+        changes = 0
+        known = 0
+
+        # Pages are written while the next ones are still being fetched
+        pages = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        producer = asyncio.create_task(produce_pages(platform, module, query, pages))
+
+        failed = False
+
+        async def ingest(batch: [dict]):
+            nonlocal changes, known, failed
+            with profiling.span('ingest', products=len(batch)):
+                written = await asyncio.to_thread(update_db_with_fetch_data, db,
+                                                  {'products': batch, 'timestamp': timestamp}, platform, query_id)
+            if written is None:
+                failed = True
+            else:
+                changes += written['changes']
+                known += written['known']
 
+        try:
+            batch = []
+            while (page := await pages.get()) is not None:
+                if log_dir:
+                    fetched.extend(page)
+
+                # The same product may appear on several pages, keep the first occurrence
+                for product in page:
+                    if product.get('id') not in seen:
+                        seen.add(product.get('id'))
+                        batch.append(product)
+
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    await ingest(batch)
+                    batch = []
+
+            if batch:
+                await ingest(batch)
+        except BaseException:
+            producer.cancel()
+            raise
+
+        # Surface fetch errors
+        await producer
+
+        if failed:
+            # Pages of the failed batches were fingerprinted but not written
+            crawl.reset_crawl(platform, query)
+        statistics.record_products(platform, query_id, len(seen))
+
+        if log_dir:
+            try:
+                path = os.path.join(log_dir, platform)
+                os.makedirs(path, exist_ok=True)
+                codec.dump({'products': fetched, 'timestamp': timestamp},
+                           os.path.join(path, f'{query}-{time.time()}.json'))
             except Exception as e:
-                print('Insert good error:', e)
-                continue
+                print('Failed to save fetched data:', e)
 
+        print('--' * 50)
+        print('')
+        return changes, known
+    except asyncio.CancelledError:
+        # Cancelled at its deadline, the queued pages were fingerprinted but not written
+        crawl.reset_crawl(platform, query)
+        raise
     except Exception as e:
-        print('Update db with fetched data error:', e)
+        print('Update DB for platform', platform, 'query', query, 'error:', e)
+        crawl.reset_crawl(platform, query)
+        return None
 
-    print('DB updated with fetched data.')
 
+async def refresh_query(platform: str, module: ModuleType, query_id: int, query: str, db: DB, interval: int,
+                        pinned: bool, bounds: (int, int), log_dir: str = None):
+    """Update a scheduled query and adapt its refresh interval to the changes found."""
+    started = time.time()
 
-def update_platform(platform: str, module: ModuleType, queries: [(int, str)], db: DB, log_dir: str = None):
-    print('Updating DB for platform', platform)
-    for query_id, query in queries:
-        try:
-            data = module.search_query(query)
-            if log_dir:
-                try:
-                    path = os.path.join(log_dir, platform)
-                    os.makedirs(path, exist_ok=True)
-                    with open(os.path.join(path, f'{query}-{time.time()}.json'), 'w') as f:
-                        json.dump(data, f, indent=2)
-                except Exception as e:
-                    print('Failed to save fetched data:', e)
-
-            update_db_with_fetch_data(db, data, platform, query_id)
-
-            print('--' * 50)
-            print('')
-        except Exception as e:
-            print('Update DB for platform', platform, 'query', query, 'error:', e)
+    # Claim the run, a run cancelled at its deadline is retried after the current interval
+    await asyncio.to_thread(db.update_schedule, platform, query_id, refresh.db_time(started + interval * 60))
 
-    print('DB updated for platform', platform)
-    print('--' * 50)
-    print('')
+    result = await update_query(platform, module, query_id, query, db, log_dir)
+
+    # The next run was already due before this one finished
+    if time.time() - started > interval * 60:
+        metrics.query_overruns.inc(platform=platform)
+
+    if result is None:
+        return
+
+    changes, known = result
+    if not pinned:
+        interval = refresh.next_interval(interval, changes, known, *bounds)
+    print('Next refresh of', platform, 'query', query, 'in', interval, 'minutes, changes:', changes, 'of', known)
+
+    await asyncio.to_thread(db.update_schedule, platform, query_id, refresh.db_time(started + interval * 60),
+                            interval, refresh.db_time(started), changes)
+
+
+async def update_platforms(platforms: [(str, ModuleType)], queries: [(int, str)], db: DB, schedules: dict,
+                           bounds: (int, int), log_dir: str = None, profile: profiling.RunProfile = None):
+    # Spans of the jobs and of the threads they start are recorded into the run profile
+    profiling.activate(profile)
+
+    # One job per due (platform, query) pair, scheduled across all platforms by the fetch engine
+    jobs = [Job(platform, module, query,
+                lambda platform=platform, module=module, query_id=query_id, query=query:
+                refresh_query(platform, module, query_id, query, db, *schedules[(platform, query_id)], bounds,
+                              log_dir))
+            for platform, module in platforms for query_id, query in queries if (platform, query_id) in schedules]
+
+    with profiling.span('run', jobs=len(jobs)):
+        stats = await fetch_engine.run_jobs(jobs)
+    print('Jobs:', stats['jobs'], 'timeouts:', stats['timeouts'], 'time:', stats['seconds'], 's', 'work:',
+          stats['work_seconds'], 's')
+
+    for platform, run in stats['platforms'].items():
+        statistics.record_platform_run(platform, run['seconds'], run['jobs'])
+
+
+def apply_update_interval(db: DB, force: bool = False) -> int:
+    """
+    Apply a changed UpdateInterval to the schedules that are not pinned, returns the number of updated schedules.
+
+    Their next run moves to the last run plus the new interval, nothing is fetched again at once.
+    """
+    global update_interval
+
+    interval = int(config.read_config_value('UpdateInterval'))
+    if update_interval is None and not force:
+        # The schedules already follow the interval the service started with
+        update_interval = interval
+        return 0
+    if interval == update_interval and not force:
+        return 0
+    update_interval = interval
+
+    count = 0
+    for platform, query_id, _, pinned, next_run, last_run, _ in db.get_schedules():
+        if pinned:
+            continue
+
+        # Schedules that never ran stay due
+        next_run = refresh.db_time(refresh.from_db_time(last_run) + interval * 60) if last_run else None
+        if db.update_schedule(platform, query_id, next_run, interval) > 0:
+            count += 1
+
+    print('Update interval', interval, 'minutes applied to', count, 'schedules')
+    return count
 
 
 def update_db(db: DB, platforms_dir: str, log_dir: str = None):
-    print('Updating DB...')
-    print('Current time: ', time.ctime())
+    """Update the (platform, query) pairs whose refresh schedule is due."""
+    # Interval changes made in the config file
+    apply_update_interval(db)
 
     queries = db.get_active_queries()
-    if queries:
-        print('Active queries: ', queries)
-    else:
-        print('No active queries.')
-        print('--' * 50)
-        print('')
+    if not queries:
         return
 
     platforms = list_platforms(platforms_dir)
-    threads = []
 
-    for platform, module in platforms:
-        # Create a thread that will run the function
-        platform_thread = threading.Thread(target=update_platform, args=(platform, module, queries, db, log_dir))
-        # Start the thread
-        platform_thread.start()
-        # Add the thread to the list
-        threads.append(platform_thread)
-
-    # Wait for all threads to finish
-    for thread in threads:
-        thread.join()
-
-    service.update_count += 1
+    # New platforms and queries get a schedule, due at once
+    db.add_schedules([platform for platform, module in platforms], [query_id for query_id, query in queries],
+                     int(config.read_config_value('UpdateInterval')))
+
+    schedules = {(platform, query_id): (interval, bool(pinned))
+                 for platform, query_id, interval, pinned in
+                 db.get_due_schedules(refresh.db_time(time.time()), [platform for platform, module in platforms])}
+    if not schedules:
+        return
+
+    print('Updating DB...')
+    print('Current time: ', time.ctime())
+    print('Due queries: ', sorted(schedules))
+
+    bounds = (int(config.read_config_value('MinUpdateInterval', default='10')),
+              int(config.read_config_value('MaxUpdateInterval', default='360')))
+
+    # Profiled if profiling was enabled from the API
+    profile = profiling.start_run()
+
+    # Fetch all due platforms and queries on the fetch engine event loop
+    try:
+        with metrics.update_run_seconds.time():
+            fetch_engine.run(update_platforms(platforms, queries, db, schedules, bounds, log_dir, profile))
+    finally:
+        if profile:
+            profiling.finish_run(profile)
+
+    # Request rates the platforms were fetched at
+    for platform, rate in ratelimit.get_rates().items():
+        print('Rate limit', platform + ':', rate['rate'], 'req/s', 'throttles:', rate['throttles'], 'waited:',
+              rate['waited'], 's')
+
+    statistics.record_update()
     print('DB updated.')
     print('--' * 50)
     print('')